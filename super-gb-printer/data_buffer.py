@@ -5,8 +5,13 @@ GB packets, and graphics data to be sent to the the POS printer. It also
 includes methods for manipulating data between different buffers.
 """
 
+import _thread
+import hashlib
+import os
 import rp2
+import struct
 import typing
+import uasyncio as asyncio
 from micropython import const
 from ulab import numpy as np
 
@@ -24,7 +29,34 @@ NUM_POS_BUFFER_SCREENS = const(2)
 PACKETS_PER_SCREEN = const(9)
 PACKET_SIZE = const(640) # 0x280
 NUM_PACKETS = NUM_GB_BUFFER_SCREENS * PACKETS_PER_SCREEN
-GB_DATA_BUFFER_DIMS = (NUM_PACKETS, PACKET_SIZE)
+# the most packets the POS buffer holds, and the page size unless told
+# otherwise (see DataBuffer.packets_per_page)
+PACKETS_PER_PAGE = NUM_POS_BUFFER_SCREENS * PACKETS_PER_SCREEN
+
+# packets are kept just as they came in, compressed or not, one after the
+# other in an arena as big as NUM_PACKETS uncompressed ones, so a print of
+# compressed packets can have a lot more of them
+ARENA_SIZE = NUM_PACKETS * PACKET_SIZE
+MAX_ARENA_PACKETS = 4 * NUM_PACKETS
+# packets start on a word boundary so they can be copied in by word DMA
+ARENA_ALIGN = const(4)
+
+# once this much of the arena is taken when a PRINT command comes in, the
+# packets are written out to a job file on flash to make room for more.
+# That's the limit on the size of a print then, not RAM. The real printer
+# only has 8 KB, so games send a PRINT at least that often, which leaves
+# plenty of room in the rest of the arena until the next one.
+SPILL_THRESHOLD = ARENA_SIZE * 3 // 4
+MAX_JOB_PACKETS = const(2048)
+JOB_FILE_PREFIX = 'job'
+JOB_FILE_SUFFIX = '.bin'
+MAX_JOB_FILES = const(100)
+# pages of a job on flash are read back into a window this big, at least
+WINDOW_BYTES = PACKETS_PER_PAGE * PACKET_SIZE
+
+# job files are written by the GB link on core 1 and read by the print task
+# on core 0, and the filesystem can't be used from both at once
+flash_lock = _thread.allocate_lock()
 
 SCREEN_WIDTH = const(160)
 SCREEN_HEIGHT = const(144)
@@ -34,12 +66,39 @@ POS_BUFFER_DIMS = (
     SCREEN_WIDTH // POS_PIXELS_PER_BYTE
 )
 
+POS_BUFFER_BYTES = 4 * POS_BUFFER_DIMS[0] * POS_BUFFER_DIMS[1]
+# spare POS buffers kept around for reuse rather than freed
+MAX_SPARE_POS_BUFFERS = const(2)
+
 BIG_ROWS_PER_PACKET = const(2)
 TILES_PER_BIG_ROW = const(20)
 BYTES_PER_ROW = const(2)
 ROWS_PER_TILE = const(8)
 BYTES_PER_TILE = ROWS_PER_TILE * BYTES_PER_ROW
 BYTES_PER_BIG_ROW = TILES_PER_BIG_ROW * BYTES_PER_TILE
+ROWS_PER_PACKET = BIG_ROWS_PER_PACKET * ROWS_PER_TILE
+
+# rows of paper fed for each unit of margin in a GB PRINT command, about how
+# much the real printer feeds
+ROWS_PER_MARGIN = const(16)
+
+# palette and exposure bytes of a PRINT command for the standard look. In
+# the palette, bits 2n+1 and 2n are the shade of color n (0 is white and 3 is
+# black), where color n has low bit n & 1 and high bit n >> 1.
+DEFAULT_PALETTE = const(0xE4)
+DEFAULT_EXPOSURE = const(0x40)
+# the real printer burns from 25% lighter at exposure 0x00 to 25% darker at
+# 0x7F, going by the Pan Docs page on the GB Printer. The POS printer only
+# has its four tones, so the range is split in bands that move gray shades
+# a step each way, with the middle half around 0x40 left as it is. The end
+# of each band, and how many shades darker it makes things.
+EXPOSURE_BANDS = ((0x20, -1), (0x60, 0), (0x80, 1))
+# shades printed in each tone (49-52)
+TONE_SHADES = ((2, 3), (1, 3), (1, 3), (1, 2, 3))
+
+# blank rows are fed past rather than printed, but runs shorter than this
+# aren't worth splitting the print up for
+MIN_BLANK_ROWS = const(4)
 
 
 class GBPacket():
@@ -56,6 +115,117 @@ class GBPacket():
         self.data = bytearray(PACKET_SIZE)
         self.checksum = 0
         self.calc_checksum = 0
+        # payload went straight to the DataBuffer instead of into data
+        self.dma_captured = False
+
+    @property
+    def checksum_ok(self) -> bool:
+        """Check if the received checksum matches the calculated one."""
+        return (self.calc_checksum & 0xFFFF) == self.checksum
+
+
+class PosBufferPool():
+    """Hands out sets of POS buffers (one array per tone) for reuse.
+
+    POS buffers are only needed for 1x and 2x prints, so they're allocated
+    the first time one is asked for rather than up front. Shared by the
+    receiving and printing DataBuffers, which are on different cores.
+    """
+
+    def __init__(self) -> None:
+        self.spares = []
+        self.lock = _thread.allocate_lock()
+
+    def acquire(self) -> list[np.ndarray]:
+        """Get a spare set of POS buffers, or make a new one."""
+
+        with self.lock:
+            if self.spares:
+                return self.spares.pop()
+        return [np.zeros(POS_BUFFER_DIMS, dtype=np.uint8) for _ in range(4)]
+
+    def release(self, pos_buffer: list[np.ndarray]) -> None:
+        """Give back a set of POS buffers once done with it."""
+
+        with self.lock:
+            if len(self.spares) < MAX_SPARE_POS_BUFFERS:
+                self.spares.append(pos_buffer)
+
+
+class PrintJob():
+    """Contains a frozen copy of the data for one finished print.
+
+    Made by DataBuffer.freeze_job on the receiving side and handed to the
+    printing side, so the GB link can carry on filling the DataBuffer with
+    the next print.
+    """
+
+    def __init__(
+            self,
+            arena: bytes,
+            packet_offset: list[int],
+            gb_compression_flag: list[bool],
+            data_length: list[int],
+        ) -> None:
+        self.arena = arena
+        self.packet_offset = packet_offset
+        self.gb_compression_flag = gb_compression_flag
+        self.data_length = data_length
+        self.num_packets = len(data_length)
+        self.num_bytes = len(arena)
+        # job file holding all the packets, if they didn't fit in RAM, in
+        # which case arena is empty
+        self.job_path = None
+        self.spilled_bytes = 0
+        # set if the job file belongs to the JobArchive and shouldn't be
+        # deleted after printing, and which archived job this is, if any
+        self.keep_job_file = False
+        self.archive_seq = -1
+        # most memory the receiving side used for the job, see
+        # DataBuffer.peak_bytes
+        self.peak_bytes = 0
+        # first page converted while the packets were coming in, if any
+        self.pos_buffer = None
+        self.num_preconverted_packets = 0
+        # the packet count and margin byte of each PRINT command in the job,
+        # see DataBuffer.print_breaks
+        self.print_breaks = []
+        # palette and exposure bytes of the last PRINT command
+        self.palette = DEFAULT_PALETTE
+        self.exposure = DEFAULT_EXPOSURE
+        # print settings at the time the job finished coming in
+        self.margins = 0
+        self.zoom = 3
+        self.add_bottom_margin = False
+        self.copies = 1
+
+    def margin_rows(self) -> tuple[dict[int, int], dict[int, int]]:
+        """Work out where the margins of each PRINT command go.
+
+        Each PRINT command covers the packets since the one before it. Its
+        margin byte has the margin before the packets in the upper nibble
+        and after them in the lower one.
+
+        Returns:
+            Two dicts from a row in the job to the rows of paper to feed
+            there, one for before the rows that start there and one for
+            after the rows that end there
+        """
+
+        before = {}
+        after = {}
+        start = 0
+        for end, margins in self.print_breaks:
+            start_row = start * ROWS_PER_PACKET
+            end_row = end * ROWS_PER_PACKET
+            before[start_row] = (
+                before.get(start_row, 0) + (margins >> 4) * ROWS_PER_MARGIN
+            )
+            after[end_row] = (
+                after.get(end_row, 0) + (margins & 0x0F) * ROWS_PER_MARGIN
+            )
+            start = end
+        return before, after
 
 
 class DataBuffer():
@@ -67,91 +237,675 @@ class DataBuffer():
 
     AnyLCD = typing.Union[lcd_i2c.LCD, fake_lcd.FakeLCD, None]
     
-    def __init__(self, lcd: AnyLCD = None) -> None:
+    def __init__(
+            self,
+            lcd: AnyLCD = None,
+            receive: bool = True,
+            pos_pool: typing.Optional[PosBufferPool] = None,
+        ) -> None:
         """Instantiate the class.
         
         Args:
             lcd: LCD instance for an optional attached LCD screen
+            receive:
+                If True, buffers for receiving packets from the GB link are
+                allocated. If False, the GB tile data comes from a PrintJob
+                given to load_job.
+            pos_pool: Where to get POS buffers from, when they're needed
         """
 
         self.lcd = lcd if lcd else fake_lcd.FakeLCD()
 
-        self.gb_buffer = np.zeros(GB_DATA_BUFFER_DIMS, dtype=np.uint8)
+        self.arena = None
+        if receive:
+            self.arena = bytearray(ARENA_SIZE)
+        self.arena_used = 0
+        # where each packet starts in the arena, see packet_data
+        self.packet_offset = [0] * MAX_ARENA_PACKETS
         self.decomp_buffer = np.zeros(PACKET_SIZE, dtype=np.uint8)
+        # packet whose data is in decomp_buffer
+        self.decomp_idx = -1
+        self.peak_bytes = 0
+        # packets up to here have been written out to the job file, and
+        # their space in the arena can be reused, see spill_packet
+        self.num_spilled_packets = 0
+        self.spilled_bytes = 0
+        # set from when spill_in_background starts until it's caught up
+        self.spilling = False
+        self.job_file = None
+        self.job_path = None
+        self.keep_job_file = False
+        self.num_job_files = 0
+        # packets read back from the job file, see load_window
+        self.window = None
+        self.window_start = 0
+        self.window_end = 0
         self.num_converted_packets = 0
         self.num_packets = 0
         self.current_page = 0
-        self.gb_compression_flag = [False] * NUM_PACKETS
-        self.data_length = [0] * NUM_PACKETS
-        self.pos_buffer = [
-            np.zeros(POS_BUFFER_DIMS, dtype=np.uint8),
-            np.zeros(POS_BUFFER_DIMS, dtype=np.uint8),
-            np.zeros(POS_BUFFER_DIMS, dtype=np.uint8),
-            np.zeros(POS_BUFFER_DIMS, dtype=np.uint8),
-        ]
-
-        self.dma = rp2.DMA()
-        self.dma_ctrl = self.dma.pack_ctrl()
+        self.num_preconverted_packets = 0
+        self.preconvert_big_row = 0
+        # whether convert_in_background fills in the first page, which is
+        # only worth it for prints that go through the POS buffer
+        self.preconvert = True
+        self.page_start = 0
+        self.page_end = 0
+        # pages can be bigger than the POS buffer, as long as they're
+        # converted as they're sent, see POSLink.page_packets
+        self.packets_per_page = PACKETS_PER_PAGE
+        # whether the current page was converted into the POS buffer
+        self.page_in_pos_buffer = False
+        self.gb_compression_flag = [False] * MAX_ARENA_PACKETS
+        self.data_length = [0] * MAX_ARENA_PACKETS
+        self.print_breaks = []
+        self.pos_pool = pos_pool if pos_pool else PosBufferPool()
+        self.pos_buffer = None
+        # the next page gets converted here while the current one prints
+        self.back_pos_buffer = None
+        self.back_page = -1
+        # which GB colors are printed in each tone, see tone_table
+        self.tone_masks = tone_table(DEFAULT_PALETTE)
+        # one tone of one packet, see zoomed_tone_rows
+        self.tone_rows = np.zeros(
+            (ROWS_PER_PACKET, TILES_PER_BIG_ROW), dtype=np.uint8
+        )
+
+        if receive:
+            self.dma = rp2.DMA()
+            self.dma_ctrl = self.dma.pack_ctrl()
+            self.rx_dma = rp2.DMA()
+            self.checksum_buffer = np.zeros(PACKET_SIZE, dtype=np.uint16)
+            self.remove_job_files()
     
     def clear_packets(self) -> None:
-        """Reset GB packets to prepare for next print."""
+        """Reset GB packets to prepare for next print.
+
+        If some of a print that never finished went out to flash, its job
+        file is deleted.
+        """
 
+        if self.job_file is not None:
+            with flash_lock:
+                self.job_file.close()
+                os.remove(self.job_path)
         self.num_packets = 0
+        self.arena_used = 0
+        self.decomp_idx = -1
+        self.peak_bytes = 0
+        self.num_spilled_packets = 0
+        self.spilled_bytes = 0
+        self.spilling = False
+        self.job_file = None
+        self.job_path = None
+        self.window_start = 0
+        self.window_end = 0
         self.current_page = 0
-        self.gb_compression_flag = [False] * NUM_PACKETS
-        self.data_length = [0] * NUM_PACKETS
+        self.num_preconverted_packets = 0
+        self.preconvert_big_row = 0
+        self.packet_offset = [0] * MAX_ARENA_PACKETS
+        self.gb_compression_flag = [False] * MAX_ARENA_PACKETS
+        self.data_length = [0] * MAX_ARENA_PACKETS
+        self.print_breaks = []
     
+    @property
+    def job_size(self) -> int:
+        """Get the memory the packets received so far take up in a PrintJob.
+
+        Includes the buffers the print side will need for it, see
+        print_overhead. Packets don't count once some have gone to flash,
+        since the rest follow them there when the job is frozen.
+        """
+        size = 0
+        if self.job_file is None:
+            size = self.arena_used
+        return size + print_overhead(
+            self.job_file is not None, self.preconvert, self.num_packets
+        )
+
+    def memory_in_use(self) -> int:
+        """Get the memory the current packets and POS buffers take up."""
+
+        size = self.arena_used - self.spilled_bytes
+        if self.window is not None:
+            size += len(self.window)
+        for pos_buffer in (self.pos_buffer, self.back_pos_buffer):
+            if pos_buffer is not None:
+                size += POS_BUFFER_BYTES
+        return size
+
+    def note_memory(self) -> None:
+        """Keep track of the most memory used for the current job."""
+
+        self.peak_bytes = max(self.peak_bytes, self.memory_in_use())
+
+    def freeze_job(self) -> PrintJob:
+        """Copy the received packets out to a PrintJob and start over.
+
+        The POS buffer goes along with the job since it may hold a first page
+        converted in the background. It goes back to the pool once the job
+        has printed (see finish_job).
+
+        If any packets went out to flash, the rest are written after them
+        and the job is printed from the job file.
+
+        Returns:
+            The PrintJob for the packets received so far
+        """
+
+        num_packets = self.num_packets
+        num_bytes = self.job_size
+        arena = b''
+        if self.job_file is not None:
+            while self.num_spilled_packets < num_packets:
+                self.spill_packet()
+            with flash_lock:
+                self.job_file.close()
+            self.job_file = None
+        else:
+            arena = bytes(memoryview(self.arena)[:self.arena_used])
+        job = PrintJob(
+            arena,
+            self.packet_offset[:num_packets],
+            self.gb_compression_flag[:num_packets],
+            self.data_length[:num_packets],
+        )
+        job.job_path = self.job_path
+        job.spilled_bytes = self.spilled_bytes
+        job.peak_bytes = self.peak_bytes
+        job.print_breaks = self.print_breaks
+        job.pos_buffer = self.pos_buffer
+        job.num_preconverted_packets = self.num_preconverted_packets
+        job.num_bytes = num_bytes
+        self.pos_buffer = None
+        self.clear_packets()
+        return job
+
+    def load_job(self, job: PrintJob) -> None:
+        """Point the printing side buffer at a frozen PrintJob.
+
+        If the job brought a POS buffer with it, that's used along with
+        its first page of converted data, unless the job's palette changes
+        how it should look.
+
+        Args:
+            job: The PrintJob to print
+        """
+
+        self.arena = job.arena
+        self.arena_used = len(job.arena) + job.spilled_bytes
+        self.packet_offset = job.packet_offset
+        self.gb_compression_flag = job.gb_compression_flag
+        self.data_length = job.data_length
+        self.num_packets = job.num_packets
+        self.decomp_idx = -1
+        self.spilled_bytes = job.spilled_bytes
+        self.num_spilled_packets = 0
+        self.job_path = job.job_path
+        self.keep_job_file = job.keep_job_file
+        self.window_start = 0
+        self.window_end = 0
+        if self.job_path:
+            self.num_spilled_packets = job.num_packets
+            with flash_lock:
+                self.job_file = open(self.job_path, 'rb')
+        self.current_page = 0
+        self.pos_buffer = job.pos_buffer
+        self.num_preconverted_packets = job.num_preconverted_packets
+        self.tone_masks = tone_table(job.palette, job.exposure)
+        if self.tone_masks != tone_table(DEFAULT_PALETTE):
+            # converted in the background before the palette was known
+            self.num_preconverted_packets = 0
+        job.pos_buffer = None
+        self.peak_bytes = 0
+        self.note_memory()
+
+    def finish_job(self) -> None:
+        """Let go of the job's data and POS buffer once it has printed.
+
+        The job file is deleted too, if it had one, unless it's being kept
+        for the archive.
+        """
+
+        for pos_buffer in (self.pos_buffer, self.back_pos_buffer):
+            if pos_buffer is not None:
+                self.pos_pool.release(pos_buffer)
+        self.pos_buffer = None
+        self.back_pos_buffer = None
+        self.back_page = -1
+        self.arena = None
+        self.arena_used = 0
+        self.window = None
+        if self.job_file is not None:
+            with flash_lock:
+                self.job_file.close()
+                if not self.keep_job_file:
+                    os.remove(self.job_path)
+        self.job_file = None
+        self.job_path = None
+        self.spilled_bytes = 0
+        self.num_spilled_packets = 0
+
+    def discard_job(self, job: PrintJob) -> None:
+        """Clean up after a frozen PrintJob that won't be printed after all.
+
+        Same as finish_job does for a printed one: the POS buffer goes back
+        to the pool and the job file is deleted, unless it's being kept for
+        the archive. The arena is let go of as well, since the job object
+        can be kept around a while longer, see JobQueue.take_dropped.
+        """
+
+        if job.pos_buffer is not None:
+            self.pos_pool.release(job.pos_buffer)
+            job.pos_buffer = None
+        if job.job_path and not job.keep_job_file:
+            with flash_lock:
+                os.remove(job.job_path)
+        job.job_path = None
+        job.arena = b''
+
     def copy_new_packet(self, packet: GBPacket) -> None:
         """Copies needed data from GBPacket to the proper buffers.
         
         Grabs the compressions flag, data length (for compressed packets)
-        and the data itself.
+        and the data itself, which is added to the arena as is.
 
         Args:
             packet: The incoming GBPacket 
         """
 
-        if self.num_packets == GB_DATA_BUFFER_DIMS:
-            raise ValueError('GB packet buffer is full!')
-        self.dma_copy_packet(packet.data, self.num_packets)
+        if self.num_packets == len(self.data_length):
+            self.grow_index()
+        length = packet.data_length
+        if not packet.dma_captured:
+            self.next_packet_space(length)
+            self.dma_copy_packet(packet.data, length)
+        self.packet_offset[self.num_packets] = self.arena_used
         self.gb_compression_flag[self.num_packets] = bool(packet.compression_flag)
-        self.data_length[self.num_packets] = packet.data_length
+        self.data_length[self.num_packets] = length
         self.num_packets += 1
-        print(f"Received new packet, I have {self.num_packets}")
+        self.arena_used += aligned(length)
+        self.note_memory()
+        print(
+            f"Received new packet, I have {self.num_packets} "
+            f"in {self.arena_used} bytes"
+        )
     
-    def dma_copy_packet(self, packet: bytearray, idx: int) -> None:
-        """Copy data packet data to GB buffer using DMA.
+    def grow_index(self) -> None:
+        """Make room in the packet index for more packets."""
+
+        if self.num_packets >= MAX_JOB_PACKETS:
+            raise ValueError('GB packet buffer is full!')
+        self.packet_offset += [0] * NUM_PACKETS
+        self.gb_compression_flag += [False] * NUM_PACKETS
+        self.data_length += [0] * NUM_PACKETS
+
+    def next_packet_space(self, length: int) -> memoryview:
+        """Get the space in the arena the next incoming packet will go in.
+
+        Offsets of packets count up through the whole job, and the arena is
+        used as a ring once packets start going out to flash. A packet that
+        doesn't fit before the end of the arena goes at the start instead.
+
+        Args:
+            length: Number of payload bytes in the packet
+        """
+
+        start = self.arena_used
+        pos = start % ARENA_SIZE
+        if pos + aligned(length) > ARENA_SIZE:
+            start += ARENA_SIZE - pos
+            pos = 0
+        if start + aligned(length) - self.spilled_bytes > ARENA_SIZE:
+            raise ValueError('GB packet buffer is full!')
+        self.arena_used = start
+        return memoryview(self.arena)[pos:pos+length]
+
+    @property
+    def arena_pos(self) -> int:
+        """Get where in the arena the next incoming packet goes."""
+        return self.arena_used % ARENA_SIZE
+
+    @property
+    def spill_due(self) -> bool:
+        """Check if there are packets to write out at the next chance."""
+        return self.spilling or (
+            self.arena_used - self.spilled_bytes >= SPILL_THRESHOLD
+        )
+
+    def spill_in_background(self) -> bool:
+        """Write the oldest packet in the arena out to flash, if it's full.
+
+        Nothing is written until the arena is SPILL_THRESHOLD full, so
+        prints that fit in RAM never touch the flash. From then on, every
+        packet in the arena is written out, one per call.
+
+        Only to be called while the Game Boy is waiting on a PRINT command
+        (see GBLink.emulating_print), which keeps showing as busy until
+        spill_due is clear. Flash writes stall both cores: a 256 byte page
+        takes about 1 ms to program, but a 4 KB sector takes about 45 ms to
+        erase, far more than the few byte times GBLink.parse_ring has to
+        reply in. While waiting, the Game Boy only sends a STATUS packet now
+        and then, so most writes fall between them. A poll that lands on an
+        erase still gets its replies late, which GBLink.late_replies counts.
+
+        Returns:
+            True if a packet was written
+        """
+
+        if not self.spill_due:
+            return False
+        if self.num_spilled_packets == self.num_packets:
+            self.spilling = False
+            return False
+        self.spilling = True
+        self.spill_packet()
+        return True
+
+    def spill_packet(self) -> None:
+        """Append the oldest packet in the arena to the job file.
+
+        The file is laid out just like the job, so a packet's offset is
+        the same in both.
+        """
+
+        if self.job_file is None:
+            with flash_lock:
+                self.job_path = self.free_job_path()
+                self.job_file = open(self.job_path, 'w+b')
+            print(f'Out of RAM, spilling packets to {self.job_path}')
+        idx = self.num_spilled_packets
+        offset = self.packet_offset[idx]
+        length = self.data_length[idx]
+        pos = offset % ARENA_SIZE
+        with flash_lock:
+            self.job_file.seek(offset)
+            self.job_file.write(memoryview(self.arena)[pos:pos+length])
+        self.num_spilled_packets += 1
+        self.spilled_bytes = offset + aligned(length)
+
+    def load_window(self, start: int, end: int) -> None:
+        """Read a range of packets back from the job file in one go.
+
+        Only the packets that have been written out are read, and no more
+        than PACKETS_PER_PAGE of them, so the window stays WINDOW_BYTES
+        even for the tall pages of a 1x or 2x print. packet_data reads the
+        next stretch when it gets there. Does nothing if they're already in
+        the window.
+
+        Args:
+            start: First packet of the range
+            end: Last packet of the range plus one
+        """
+
+        end = min(end, self.num_spilled_packets, start + PACKETS_PER_PAGE)
+        if start >= end:
+            return
+        first = self.packet_offset[start]
+        last = self.packet_offset[end-1] + self.data_length[end-1]
+        if self.window_start <= first and last <= self.window_end:
+            return
+        size = last - first
+        if self.window is None or len(self.window) < size:
+            self.window = bytearray(max(size, WINDOW_BYTES))
+        with flash_lock:
+            self.job_file.seek(first)
+            self.job_file.readinto(memoryview(self.window)[:size])
+        self.window_start = first
+        self.window_end = last
+        self.note_memory()
+
+    def free_job_path(self) -> str:
+        """Pick the next job file name that isn't taken. Hold flash_lock.
+
+        Names go around MAX_JOB_FILES of them. One that's still on flash
+        belongs to a queued job, or one printed and waiting to go in the
+        JobArchive, so it's skipped rather than written over.
+        """
+
+        names = os.listdir()
+        for _ in range(MAX_JOB_FILES):
+            path = f'{JOB_FILE_PREFIX}{self.num_job_files}{JOB_FILE_SUFFIX}'
+            self.num_job_files = (self.num_job_files + 1) % MAX_JOB_FILES
+            if path not in names:
+                return path
+        raise OSError('No job file names left!')
+
+    @staticmethod
+    def remove_job_files() -> None:
+        """Delete any job files left over from before a reset."""
+
+        with flash_lock:
+            for name in os.listdir():
+                if (
+                    name.startswith(JOB_FILE_PREFIX)
+                    and name.endswith(JOB_FILE_SUFFIX)
+                ):
+                    os.remove(name)
+
+    def capture_packet_dma(
+            self, src: int, treq: int, offset: int, count: int
+        ) -> None:
+        """Capture packet payload bytes into the next free space using DMA.
+
+        The transfer is paced by the PIO RX FIFO, so it finishes as the last
+        byte comes in from the Game Boy, at which point rx_dma's IRQ fires.
+
+        Args:
+            src: Address of the PIO RX FIFO register
+            treq: DREQ number of the PIO RX FIFO
+            offset: Where in the packet to start writing
+            count: Number of bytes to capture
+        """
+
+        self.rx_dma.config(
+            read = src,
+            write = memoryview(self.arena)[self.arena_pos+offset:],
+            count = count,
+            ctrl = self.rx_dma.pack_ctrl(
+                size = 0, inc_read = False, treq_sel = treq, irq_quiet = False
+            ),
+            trigger = True
+        )
+
+    def payload_sum(self, length: int) -> int:
+        """Sum the bytes captured into the next free space, for the checksum.
+
+        Bytes are widened to 16 bits first so the sum can't wrap at 8 bits.
+
+        Args:
+            length: Number of payload bytes captured
+        """
+
+        self.checksum_buffer[:length] = np.frombuffer(
+            self.arena, dtype=np.uint8, count=length, offset=self.arena_pos
+        )
+        return int(np.sum(self.checksum_buffer[:length])) & 0xFFFF
+
+    def dma_copy_packet(self, packet: bytearray, length: int) -> None:
+        """Copy data packet data to the next free space using DMA.
+
+        Copies whole words, so up to 3 bytes past the end of the payload go
+        along too. They're in the padding before the next packet.
 
         Args:
             packet: The bytearray from a GBPacket
-            idx: the index in the GB tile buffer where incoming data will go
+            length: Number of payload bytes in the packet
         """
 
         self.dma.config(
             read = packet,
-            write = self.gb_buffer[idx,:],
-            count = len(packet) // 4,
+            write = memoryview(self.arena)[self.arena_pos:],
+            count = (length + ARENA_ALIGN - 1) // ARENA_ALIGN,
             ctrl = self.dma_ctrl,
             trigger = True
         )
         
-    def convert_page_of_packets(self, page: int) -> int:
-        """Converts one page (18 packets) of data.
+    def convert_page_of_packets(self, page: int, to_pos: bool = True) -> int:
+        """Converts one page (packets_per_page packets) of data.
         
         Args:
             page: Naturally, the page to convert
+            to_pos:
+                If False, the page is only selected for zoomed_tone_rows to
+                convert as it's sent, and the POS buffer isn't used. Pages
+                bigger than PACKETS_PER_PAGE have to be done that way.
         
         Returns:
             Number of packets converted
         """
 
         self.current_page = page + 1
-        p_low = page*18
-        p_hi = min((page+1)*18, self.num_packets)
-        self.convert_packet_range(p_low, p_hi)
+        p_low, p_hi = self.page_range(page)
+        self.page_start = p_low
+        self.page_end = p_hi
+        # stream the page back from flash, if that's where the job is
+        self.load_window(p_low, p_hi)
+        self.page_in_pos_buffer = to_pos
+        if not to_pos:
+            return p_hi - p_low
+        if p_hi - p_low > PACKETS_PER_PAGE:
+            raise ValueError('Page is too big for the POS buffer!')
+        if self.back_page == page:
+            # already converted by convert_page_in_back
+            self.pos_buffer, self.back_pos_buffer = (
+                self.back_pos_buffer, self.pos_buffer
+            )
+            self.back_page = -1
+            self.num_converted_packets = p_hi - p_low
+            return p_hi - p_low
+        if self.pos_buffer is None:
+            self.pos_buffer = self.pos_pool.acquire()
+            self.note_memory()
+        # the first page may have been converted while packets came in
+        skip = self.num_preconverted_packets if page == 0 else 0
+        self.convert_packet_range(p_low, p_hi, skip)
         return p_hi - p_low
         
-    def convert_packet_range(self, start: int, end: int) -> None:
+    def blank_rows(self, gb_idx: int) -> list[bool]:
+        """Find the rows of pixels in a packet that are all white.
+
+        Goes by the tone masks, since with some palettes color 0 is printed
+        and another color is left white.
+
+        Args:
+            gb_idx: Index of packet in the GB tile buffer
+
+        Returns:
+            True for each of the 16 rows that's blank
+        """
+
+        tiles = self.packet_data(gb_idx).reshape(
+            (BIG_ROWS_PER_PACKET * TILES_PER_BIG_ROW, BYTES_PER_TILE)
+        )
+        # pixels printed in any tone
+        masks = self.tone_masks
+        printed = self.tone_plane(
+            tiles[:, 0::2], tiles[:, 1::2],
+            masks[0] | masks[1] | masks[2] | masks[3],
+        )
+        blank = []
+        for big_row in range(BIG_ROWS_PER_PACKET):
+            tile = big_row * TILES_PER_BIG_ROW
+            ink = np.max(printed[tile:tile+TILES_PER_BIG_ROW,:], axis=0)
+            for row in range(ROWS_PER_TILE):
+                blank.append(not ink[row])
+        return blank
+
+    def page_bands(
+            self, splits: typing.Optional[set[int]] = None
+        ) -> list[tuple[int, int, bool]]:
+        """Split the current page into bands of blank and non-blank rows.
+
+        Blank runs shorter than MIN_BLANK_ROWS are left in with the rows
+        around them.
+
+        Args:
+            splits: Rows in the page that a band must start at, like where
+                the data of each GB PRINT command starts
+
+        Returns:
+            The start row, end row plus one and whether it's blank, for each
+            band in order
+        """
+
+        blank = []
+        for gb_idx in range(self.page_start, self.page_end):
+            blank += self.blank_rows(gb_idx)
+
+        if splits is None:
+            splits = set()
+        bands = []
+        start = 0
+        for row in range(1, len(blank) + 1):
+            if (
+                row < len(blank)
+                and blank[row] == blank[start]
+                and row not in splits
+            ):
+                continue
+            is_blank = blank[start] and row - start >= MIN_BLANK_ROWS
+            if bands and bands[-1][2] == is_blank and start not in splits:
+                start = bands.pop()[0]
+            bands.append((start, row, is_blank))
+            start = row
+        return bands
+
+    def band_hash(self, start_row: int, end_row: int, zoom: int) -> bytes:
+        """Get a hash of what a band of the current page prints as.
+
+        Covers the whole packets the band is in, along with the rows, zoom
+        and tone masks, so two bands with the same hash print the same.
+
+        Args:
+            start_row: First row of the band in the current page
+            end_row: Last row of the band plus one
+            zoom: Zoom level of the print
+        """
+
+        first = self.page_start + start_row // ROWS_PER_PACKET
+        last = self.page_start + (end_row - 1) // ROWS_PER_PACKET
+        skip = (first - self.page_start) * ROWS_PER_PACKET
+        # rows go past 255 in the tall pages used at 1x and 2x
+        h = hashlib.sha256(
+            struct.pack('<HHB', start_row - skip, end_row - skip, zoom)
+            + bytes(self.tone_masks)
+        )
+        for gb_idx in range(first, last + 1):
+            h.update(self.packet_data(gb_idx).tobytes())
+        return h.digest()
+
+    def page_range(self, page: int) -> tuple[int, int]:
+        """Get the first packet of a page and the last one plus one."""
+
+        p_low = page * self.packets_per_page
+        p_hi = min((page+1) * self.packets_per_page, self.num_packets)
+        return p_low, p_hi
+
+    async def convert_page_in_back(self, page: int) -> None:
+        """Converts a page into the back POS buffer, a packet at a time.
+
+        Meant to run as a task while the page before it is being uploaded
+        and printed from the front POS buffer. Yields after each packet so
+        the upload keeps going. convert_page_of_packets then just swaps the
+        buffers when it gets to this page.
+
+        Args:
+            page: The page to convert
+        """
+
+        if self.back_pos_buffer is None:
+            self.back_pos_buffer = self.pos_pool.acquire()
+            self.note_memory()
+        self.back_page = -1
+        p_low, p_hi = self.page_range(page)
+        for pos_idx in range(p_hi - p_low):
+            self.convert_one_packet(
+                p_low + pos_idx, pos_idx, self.back_pos_buffer
+            )
+            await asyncio.sleep_ms(0)
+        self.back_page = page
+
+    def convert_packet_range(self, start: int, end: int, skip: int = 0) -> None:
         """Converts a range of packets from GB tile to POS graphics format.
         
         Used by the above methods that specify what that range is.
@@ -162,6 +916,9 @@ class DataBuffer():
             end: 
                 Ending packet in the GB tile filter plus one, thanks to 
                 Python indexing 
+            skip:
+                Number of packets at the start of the range that are already
+                converted in the POS buffer
         """
 
         self.lcd.clear()
@@ -169,13 +926,49 @@ class DataBuffer():
         if self.num_pages > 1:
             self.lcd.set_cursor(0, 1)
             self.lcd.print(f"Page {self.current_page}/{self.num_pages}")
-        for pos_idx, gb_idx in enumerate(range(start, end)):
+        for pos_idx in range(skip, end - start):
+            gb_idx = start + pos_idx
             self.lcd.set_cursor(11, 0)
             self.lcd.print(f"{gb_idx}")
             self.convert_one_packet(gb_idx, pos_idx)
         self.num_converted_packets = end - start
+
+    def convert_in_background(self) -> bool:
+        """Do one small step of preparing received packets for printing.
+
+        Meant to be called from the main loop while the GB link is between
+        packets, so each call is kept short: it converts one big row of a
+        first page packet into the POS buffer. Once PRINT arrives, the first
+        page is ready to upload. Nothing is done if preconvert is off.
+
+        Returns:
+            True if there was any work to do
+        """
+
+        first_page_end = min(self.num_packets, PACKETS_PER_PAGE)
+        if (
+            self.preconvert
+            and self.num_preconverted_packets < first_page_end
+        ):
+            if self.pos_buffer is None:
+                self.pos_buffer = self.pos_pool.acquire()
+                self.note_memory()
+            idx = self.num_preconverted_packets
+            self.convert_big_row(idx, idx, self.preconvert_big_row)
+            self.preconvert_big_row += 1
+            if self.preconvert_big_row == BIG_ROWS_PER_PACKET:
+                self.preconvert_big_row = 0
+                self.num_preconverted_packets += 1
+            return True
+
+        return False
     
-    def convert_one_packet(self, gb_idx: int, pos_idx: int = -1) -> None:
+    def convert_one_packet(
+            self,
+            gb_idx: int,
+            pos_idx: int = -1,
+            pos_buffer: typing.Optional[list[np.ndarray]] = None,
+        ) -> None:
         """Converts one packet from GB tile to POS graphics format.
 
         Args:
@@ -185,56 +978,177 @@ class DataBuffer():
                 Index of data in the POS graphics data buffer. May be 
                 different than gb_idx since the buffers are different sizes
                 and data is generally converted one page at a time.
+            pos_buffer: POS buffer to convert into, if not the front one
         """
 
-        if self.gb_compression_flag[gb_idx]:
-            self.decompress_packet_in_buffer(gb_idx)
         if pos_idx == -1:
             pos_idx = gb_idx
 
-        # big row is a row of GB tiles
-        for big_row in range(BIG_ROWS_PER_PACKET):
-            for tile_idx in range(TILES_PER_BIG_ROW):
-                tile_offset = (
-                    big_row * BYTES_PER_BIG_ROW
-                    + tile_idx * BYTES_PER_TILE
-                )
+        trow = pos_idx * BIG_ROWS_PER_PACKET * ROWS_PER_TILE
+        self.convert_tile_rows(self.packet_data(gb_idx), trow, pos_buffer)
+
+    def convert_big_row(self, gb_idx: int, pos_idx: int, big_row: int) -> None:
+        """Converts one row of GB tiles in a packet to POS graphics format.
 
-                # each row is two bytes, little endian
-                lbytes = self.gb_buffer[
-                    gb_idx, tile_offset : tile_offset+BYTES_PER_TILE : 2
-                ]
-                hbytes = self.gb_buffer[
-                    gb_idx, tile_offset+1:tile_offset+BYTES_PER_TILE+1:2
-                ]
-
-                # white doesn't need to be tracked since it's not printed
-                # white        = ~lbytes & ~hbytes
-                lightgray_tile =  lbytes & ~hbytes
-                darkgray_tile  = ~lbytes &  hbytes
-                black_tile     =  lbytes &  hbytes
-                
-                tone49_tile = black_tile | darkgray_tile 
-                tone50_tile = black_tile | lightgray_tile 
-                tone51_tile = black_tile | lightgray_tile 
-                tone52_tile = black_tile | darkgray_tile | lightgray_tile 
-
-                trow = (pos_idx * 2 + big_row) * ROWS_PER_TILE
-
-                self.pos_buffer[0][trow:trow+8, tile_idx] = tone49_tile
-                self.pos_buffer[1][trow:trow+8, tile_idx] = tone50_tile
-                self.pos_buffer[2][trow:trow+8, tile_idx] = tone51_tile
-                self.pos_buffer[3][trow:trow+8, tile_idx] = tone52_tile
+        Args:
+            gb_idx: Index of packet in the GB tile buffer to be converted
+            pos_idx: Index of data in the POS graphics data buffer
+            big_row: Which row of tiles in the packet to convert
+        """
+
+        offset = big_row * BYTES_PER_BIG_ROW
+        trow = (pos_idx * BIG_ROWS_PER_PACKET + big_row) * ROWS_PER_TILE
+        self.convert_tile_rows(
+            self.packet_data(gb_idx)[offset:offset+BYTES_PER_BIG_ROW], trow
+        )
+
+    def convert_tile_rows(
+            self,
+            tile_data: np.ndarray,
+            trow: int,
+            pos_buffer: typing.Optional[list[np.ndarray]] = None,
+        ) -> None:
+        """Converts whole rows of GB tiles to POS graphics format at once.
+
+        Rather than going tile by tile, the tones are worked out for every
+        byte in one go, then each tone is reshaped so there's a tile per
+        column and copied to the POS buffer a big row at a time.
+
+        Args:
+            tile_data: Decompressed GB tile data for one or more big rows
+            trow: Row in the POS buffer where the first big row goes
+            pos_buffer: POS buffer to convert into, if not the front one
+        """
+
+        # each row is two bytes, little endian
+        lbytes = tile_data[0::2]
+        hbytes = tile_data[1::2]
+
+        if pos_buffer is None:
+            pos_buffer = self.pos_buffer
+        for mask, pos_tone in zip(self.tone_masks, pos_buffer):
+            plane = self.tone_plane(lbytes, hbytes, mask)
+            self.untile(plane, pos_tone, trow)
+
+    @staticmethod
+    def tone_plane(
+            lbytes: np.ndarray, hbytes: np.ndarray, mask: int
+        ) -> np.ndarray:
+        """Works out which pixels are printed in one tone.
+
+        Whichever colors are printed, it's some bitwise function of the low
+        and high bytes, picked from TONE_FUNCTIONS by the tone's mask. With
+        the standard palette, the tones boil down to:
+            tone49 = black | darkgray             = hbytes
+            tone50 = black | lightgray            = lbytes
+            tone51 = black | lightgray            = lbytes
+            tone52 = black | darkgray | lightgray = lbytes | hbytes
+
+        Args:
+            lbytes: Low bytes of the rows of GB tiles
+            hbytes: High bytes of the rows of GB tiles
+            mask: The tone's mask from tone_table
+
+        Returns:
+            One byte per row of each tile, in the same order as the input
+        """
+
+        return TONE_FUNCTIONS[mask](lbytes, hbytes)
+
+    @staticmethod
+    def untile(plane: np.ndarray, out: np.ndarray, trow: int = 0) -> None:
+        """Copies one tone of whole rows of GB tiles into rows of pixels.
+
+        Args:
+            plane: One byte per row of each tile, in GB tile order
+            out: Array with one byte per 8 pixels, 20 bytes per row
+            trow: Row in out where the first row of tiles goes
+        """
+
+        num_tiles = len(plane) // ROWS_PER_TILE
+        # rows of a tile are next to each other, so after this each column
+        # is a tile
+        plane = plane.reshape((num_tiles, ROWS_PER_TILE)).transpose()
+        for big_row in range(num_tiles // TILES_PER_BIG_ROW):
+            row = trow + big_row * ROWS_PER_TILE
+            tile = big_row * TILES_PER_BIG_ROW
+            out[row:row+ROWS_PER_TILE, :] = (
+                plane[:, tile:tile+TILES_PER_BIG_ROW]
+            )
+
+    def zoomed_tone_rows(
+            self, gb_idx: int, tone: int,
+            zoom_lut: typing.Optional[np.ndarray] = None,
+        ) -> np.ndarray:
+        """Converts one tone of a packet straight to zoomed printer rows.
+
+        Used for prints zoomed by 3x or more, where the rows are stretched
+        before sending anyway, and for pages too big for the POS buffer, so
+        there's no need to go through the POS buffer first.
+
+        Args:
+            gb_idx: Index of packet in the GB tile buffer to be converted
+            tone: The tone number, 0-3
+            zoom_lut:
+                LUT from a byte to its bits stretched out by the zoom, or
+                None to leave the rows as they are
+
+        Returns:
+            An array of 16 rows, each stretched horizontally by the zoom.
+            Without a LUT, it's only good until the next call.
+        """
+
+        packet = self.packet_data(gb_idx)
+        plane = self.tone_plane(
+            packet[0::2], packet[1::2], self.tone_masks[tone]
+        )
+        self.untile(plane, self.tone_rows)
+        if zoom_lut is None:
+            return self.tone_rows
+        return zoom_rows(self.tone_rows, zoom_lut)
     
-    def decompress_packet_in_buffer(self, packet_idx: int) -> None:
-        """Decompresses a packet and copies results back to GB tile buffer.
-        
+    def packet_data(self, packet_idx: int) -> np.ndarray:
+        """Get the tile data of a packet, decompressing it if needed.
+
+        Uncompressed packets are a view straight into the arena, or the
+        window if the packet is on flash. Compressed ones are decompressed
+        into decomp_buffer, which holds one packet at a time, so the result
+        is only good until the next call.
+
         Args:
-            packet_idx: Index of packet to be decompressed
+            packet_idx: Index of the packet
+
+        Returns:
+            The packet's PACKET_SIZE bytes of tile data
         """
+
+        if packet_idx == self.decomp_idx:
+            return self.decomp_buffer
         dl = self.data_length[packet_idx]
-        self.decompress_packet_data(self.gb_buffer[packet_idx,:], dl)
-        self.gb_buffer[packet_idx,:] = self.decomp_buffer
+        offset = self.packet_offset[packet_idx]
+        if packet_idx < self.num_spilled_packets:
+            # read back along with the rest of its page, a window at a time
+            if not self.window_start <= offset < self.window_end:
+                page = packet_idx // self.packets_per_page
+                self.load_window(packet_idx, self.page_range(page)[1])
+            buffer = self.window
+            offset -= self.window_start
+        else:
+            buffer = self.arena
+            offset %= ARENA_SIZE
+        data = np.frombuffer(buffer, dtype=np.uint8, count=dl, offset=offset)
+        if not self.gb_compression_flag[packet_idx]:
+            if dl == PACKET_SIZE:
+                return data
+            # short packet, pad it out with whatever color prints white
+            color = paper_color(self.tone_masks)
+            self.decomp_buffer[0::2] = 0xFF if color & 1 else 0
+            self.decomp_buffer[1::2] = 0xFF if color & 2 else 0
+            self.decomp_buffer[:dl] = data
+        else:
+            self.decompress_packet_data(data, dl)
+        self.decomp_idx = packet_idx
+        return self.decomp_buffer
     
     def decompress_packet_data(
             self, comp_packet: np.ndarray, data_length: int
@@ -270,7 +1184,357 @@ class DataBuffer():
     
     @property
     def num_pages(self):
-        """Get the number of pages (18 packets) received."""
-        return ((self.num_packets - 1) // 18) + 1
+        """Get the number of pages (packets_per_page packets) received."""
+        return ((self.num_packets - 1) // self.packets_per_page) + 1
     
 
+
+
+# each tone is a bitwise function of the low (l) and high (h) bytes, indexed
+# by its mask from tone_table. lbytes and hbytes are strided views, so they're
+# copied when used as is, so the result can be reshaped.
+TONE_FUNCTIONS = (
+    lambda l, h: l & ~l,        # nothing
+    lambda l, h: ~(l | h),      # 0
+    lambda l, h: l & ~h,        # 1
+    lambda l, h: ~h,            # 0, 1
+    lambda l, h: ~l & h,        # 2
+    lambda l, h: ~l,            # 0, 2
+    lambda l, h: l ^ h,         # 1, 2
+    lambda l, h: ~(l & h),      # 0, 1, 2
+    lambda l, h: l & h,         # 3
+    lambda l, h: ~(l ^ h),      # 0, 3
+    lambda l, h: l.copy(),      # 1, 3
+    lambda l, h: l | ~h,        # 0, 1, 3
+    lambda l, h: h.copy(),      # 2, 3
+    lambda l, h: ~l | h,        # 0, 2, 3
+    lambda l, h: l | h,         # 1, 2, 3
+    lambda l, h: l | ~l,        # everything
+)
+
+_tone_tables = {}
+
+
+def print_overhead(spilled: bool, to_pos: bool, num_packets: int) -> int:
+    """Get the memory the print side needs for a job besides its packets.
+
+    Args:
+        spilled: Whether the job is on flash, and read back through a window
+        to_pos: Whether its pages go through POS buffers, in which case
+            there's a second one to convert the next page into if there's
+            more than one page
+        num_packets: Number of packets in the job
+    """
+
+    size = WINDOW_BYTES if spilled else 0
+    if to_pos and num_packets:
+        num_buffers = 2 if num_packets > PACKETS_PER_PAGE else 1
+        size += num_buffers * POS_BUFFER_BYTES
+    return size
+
+
+def aligned(length: int) -> int:
+    """Round a packet length up to where the next one starts in the arena."""
+    return (length + ARENA_ALIGN - 1) & ~(ARENA_ALIGN - 1)
+
+
+def exposure_shift(exposure: int) -> int:
+    """Get how many shades darker an exposure byte makes things.
+
+    0x40 is normal, down to 0x00 is lighter and up to 0x7F is darker, see
+    EXPOSURE_BANDS. White stays white and nothing gets lighter than light
+    gray.
+    """
+
+    exposure &= 0x7F
+    for end, shift in EXPOSURE_BANDS:
+        if exposure < end:
+            return shift
+    return 0
+
+
+def tone_table(
+        palette: int, exposure: int = DEFAULT_EXPOSURE
+    ) -> tuple[int, int, int, int]:
+    """Work out which GB colors are printed in each tone.
+
+    Cached, since there are only a few palettes a game will use.
+
+    Args:
+        palette: Palette byte from the PRINT command
+        exposure: Exposure byte from the PRINT command
+
+    Returns:
+        A mask for each tone, with bit n set if color n is printed in it
+    """
+
+    shift = exposure_shift(exposure)
+    key = (palette, shift)
+    if key in _tone_tables:
+        return _tone_tables[key]
+    if palette == 0:
+        # some games send 0 and mean the standard palette
+        palette = DEFAULT_PALETTE
+    masks = [0, 0, 0, 0]
+    for color in range(4):
+        shade = (palette >> (2 * color)) & 3
+        if shade:
+            shade = min(max(shade + shift, 1), 3)
+        for tone, shades in enumerate(TONE_SHADES):
+            if shade in shades:
+                masks[tone] |= 1 << color
+    table = tuple(masks)
+    _tone_tables[key] = table
+    return table
+
+
+def paper_color(masks: tuple[int, int, int, int]) -> int:
+    """Find a GB color that isn't printed in any tone, leaving the paper.
+
+    Args:
+        masks: Tone masks from tone_table
+
+    Returns:
+        The color, or 0 if every color gets printed
+    """
+
+    printed = masks[0] | masks[1] | masks[2] | masks[3]
+    for color in range(4):
+        if not printed & (1 << color):
+            return color
+    return 0
+
+
+def reference_tone_plane(
+        tile_data: bytes, tone: int, palette: int,
+        exposure: int = DEFAULT_EXPOSURE,
+    ) -> bytes:
+    """Works out one tone of GB tile data pixel by pixel.
+
+    Slow, but straight from the definitions. Used to check tone_plane.
+
+    Returns:
+        One byte per row of each tile, like tone_plane
+    """
+
+    if palette == 0:
+        palette = DEFAULT_PALETTE
+    shift = exposure_shift(exposure)
+    plane = bytearray(len(tile_data) // 2)
+    for i in range(len(plane)):
+        low = tile_data[2*i]
+        high = tile_data[2*i+1]
+        for bit in range(8):
+            color = ((low >> bit) & 1) | (((high >> bit) & 1) << 1)
+            shade = (palette >> (2 * color)) & 3
+            if shade:
+                shade = min(max(shade + shift, 1), 3)
+            if shade in TONE_SHADES[tone]:
+                plane[i] |= 1 << bit
+    return bytes(plane)
+
+
+def zoom_rows(rows: np.ndarray, zoom_lut: np.ndarray) -> np.ndarray:
+    """Stretches rows of POS data horizontally with one LUT gather.
+
+    Args:
+        rows: 2D array of POS data, one byte per 8 pixels
+        zoom_lut: LUT from a byte to its bits stretched out by the zoom
+
+    Returns:
+        The rows, each zoom times as long
+    """
+
+    num_rows, row_bytes = rows.shape
+    zoom = zoom_lut.shape[1]
+    zoomed = np.take(zoom_lut, rows.reshape((num_rows * row_bytes,)), axis=0)
+    return zoomed.reshape((num_rows, row_bytes * zoom))
+
+
+def reference_convert_one_packet(
+        buffer: DataBuffer, gb_idx: int, pos_idx: int
+    ) -> None:
+    """Converts a packet one tile at a time, the way it used to be done.
+
+    Kept to check convert_one_packet against and to benchmark it.
+    """
+
+    packet = buffer.packet_data(gb_idx)
+    for big_row in range(BIG_ROWS_PER_PACKET):
+        for tile_idx in range(TILES_PER_BIG_ROW):
+            tile_offset = (
+                big_row * BYTES_PER_BIG_ROW
+                + tile_idx * BYTES_PER_TILE
+            )
+            lbytes = packet[tile_offset : tile_offset+BYTES_PER_TILE : 2]
+            hbytes = packet[tile_offset+1:tile_offset+BYTES_PER_TILE+1:2]
+
+            lightgray_tile =  lbytes & ~hbytes
+            darkgray_tile  = ~lbytes &  hbytes
+            black_tile     =  lbytes &  hbytes
+
+            tone49_tile = black_tile | darkgray_tile
+            tone50_tile = black_tile | lightgray_tile
+            tone51_tile = black_tile | lightgray_tile
+            tone52_tile = black_tile | darkgray_tile | lightgray_tile
+
+            trow = (pos_idx * 2 + big_row) * ROWS_PER_TILE
+
+            buffer.pos_buffer[0][trow:trow+8, tile_idx] = tone49_tile
+            buffer.pos_buffer[1][trow:trow+8, tile_idx] = tone50_tile
+            buffer.pos_buffer[2][trow:trow+8, tile_idx] = tone51_tile
+            buffer.pos_buffer[3][trow:trow+8, tile_idx] = tone52_tile
+
+
+if __name__ == "__main__":
+    # check the conversion against the old one with random data and time
+    # a full page of each
+    import os
+    import utime
+
+    buf = DataBuffer()
+    buf.pos_buffer = buf.pos_pool.acquire()
+    packet = GBPacket()
+    packet.data_length = PACKET_SIZE
+    # as if DMA had captured it
+    packet.dma_captured = True
+    for i in range(PACKETS_PER_PAGE):
+        buf.next_packet_space(PACKET_SIZE)[:] = os.urandom(PACKET_SIZE)
+        buf.copy_new_packet(packet)
+
+    t = utime.ticks_us()
+    for i in range(PACKETS_PER_PAGE):
+        reference_convert_one_packet(buf, i, i)
+    ref_time = utime.ticks_diff(utime.ticks_us(), t)
+    expected = [np.array(x) for x in buf.pos_buffer]
+    for x in buf.pos_buffer:
+        x[:] = 0
+
+    t = utime.ticks_us()
+    for i in range(PACKETS_PER_PAGE):
+        buf.convert_one_packet(i, i)
+    new_time = utime.ticks_diff(utime.ticks_us(), t)
+
+    for tone, (exp, got) in enumerate(zip(expected, buf.pos_buffer)):
+        if not np.all(exp == got):
+            raise AssertionError(f'Tone {tone} does not match!')
+    print(f'Page of {PACKETS_PER_PAGE} packets, output matches')
+    print(f'Tile by tile: {ref_time} us, whole packet: {new_time} us')
+    print(f'Speedup: {ref_time / new_time:.1f}x')
+
+    # the fused 3x path should give the same rows as zooming the POS buffer
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    for b in range(256):
+        bits = 0
+        for i in range(8):
+            if b & (1 << i):
+                bits |= 0b111 << (3 * i)
+        lut[b,:] = np.array([bits >> 16, (bits >> 8) & 0xFF, bits & 0xFF])
+    t = utime.ticks_us()
+    for i in range(PACKETS_PER_PAGE):
+        for tone in range(4):
+            rows = buf.zoomed_tone_rows(i, tone, lut)
+            trow = i * ROWS_PER_PACKET
+            pos_rows = expected[tone][trow:trow+ROWS_PER_PACKET,:]
+            for r in range(ROWS_PER_PACKET):
+                for px in range(TILES_PER_BIG_ROW):
+                    exp = lut[pos_rows[r,px]]
+                    if not np.all(rows[r,px*3:px*3+3] == exp):
+                        raise AssertionError(f'Zoomed tone {tone} differs!')
+    fused_time = utime.ticks_diff(utime.ticks_us(), t)
+    print(f'Fused 3x rows match, {fused_time} us including checks')
+
+    # every palette, and the exposures at the ends of each band, against
+    # the pixel by pixel reference
+    tile_data = buf.packet_data(0)[:64]
+    lbytes = tile_data[0::2]
+    hbytes = tile_data[1::2]
+    raw = tile_data.tobytes()
+    settings = [(palette, DEFAULT_EXPOSURE) for palette in range(256)]
+    settings += [
+        (DEFAULT_PALETTE, exposure)
+        for exposure in (0x00, 0x1F, 0x20, 0x5F, 0x60, 0x7F)
+    ]
+    for palette, exposure in settings:
+        masks = tone_table(palette, exposure)
+        for tone in range(4):
+            got = DataBuffer.tone_plane(lbytes, hbytes, masks[tone])
+            exp = reference_tone_plane(raw, tone, palette, exposure)
+            if got.tobytes() != exp:
+                raise AssertionError(
+                    f'Palette {palette:02X} exposure {exposure:02X} '
+                    f'tone {tone} does not match!'
+                )
+    print(f'All {len(settings)} palette/exposure settings match')
+
+    # a compressed packet is stored as is and comes out the same as the
+    # uncompressed one
+    # 128 white bytes, then the rest from packet 1 as it is
+    literal = buf.packet_data(1).tobytes()[:PACKET_SIZE-128]
+    expected = bytes(128) + literal
+    comp = bytearray([0x80 + 126, 0])
+    for i in range(0, len(literal), 128):
+        comp += bytes([127]) + literal[i:i+128]
+    buf.next_packet_space(len(comp))[:] = comp
+    packet.compression_flag = 1
+    packet.data_length = len(comp)
+    buf.copy_new_packet(packet)
+    packet.compression_flag = 0
+    packet.data_length = PACKET_SIZE
+    idx = buf.num_packets - 1
+    got = buf.packet_data(idx).tobytes()
+    if got != expected:
+        raise AssertionError('Compressed packet does not match!')
+    print(f'Compressed packet matches, {buf.arena_used} bytes in the arena')
+
+    # with palette 1B, color 0 is black and color 3 is the paper
+    buf.clear_packets()
+    for length in (PACKET_SIZE, PACKET_SIZE // 2):
+        buf.next_packet_space(length)[:] = bytes(length)
+        packet.data_length = length
+        buf.copy_new_packet(packet)
+    packet.data_length = PACKET_SIZE
+    buf.convert_page_of_packets(0, to_pos=False)
+    if buf.page_bands() != [(0, 2 * ROWS_PER_PACKET, True)]:
+        raise AssertionError('Zeros are not blank with palette E4!')
+    buf.tone_masks = tone_table(0x1B)
+    buf.decomp_idx = -1
+    half = ROWS_PER_PACKET + ROWS_PER_PACKET // 2
+    bands = [(0, half, False), (half, 2 * ROWS_PER_PACKET, True)]
+    if buf.page_bands() != bands:
+        raise AssertionError('Black is blank or padding prints with 1B!')
+    buf.tone_masks = tone_table(DEFAULT_PALETTE)
+    print('Blank rows follow the palette')
+
+    # a print too big for the arena goes out to flash and comes back the same
+    buf.clear_packets()
+    num_packets = 2 * NUM_PACKETS
+    for i in range(num_packets):
+        buf.next_packet_space(PACKET_SIZE)[:] = bytes([i]) * PACKET_SIZE
+        buf.copy_new_packet(packet)
+        while buf.spill_in_background():
+            pass
+    job = buf.freeze_job()
+    printing = DataBuffer(receive=False)
+    printing.load_job(job)
+    for page in range(printing.num_pages):
+        printing.convert_page_of_packets(page, to_pos=False)
+        for i in range(printing.page_start, printing.page_end):
+            if printing.packet_data(i).tobytes() != bytes([i]) * PACKET_SIZE:
+                raise AssertionError(f'Spilled packet {i} does not match!')
+    # tall 1x pages are read back a window at a time
+    printing.packets_per_page = 4 * PACKETS_PER_PAGE
+    for page in range(printing.num_pages):
+        printing.convert_page_of_packets(page, to_pos=False)
+        for i in range(printing.page_start, printing.page_end):
+            if printing.packet_data(i).tobytes() != bytes([i]) * PACKET_SIZE:
+                raise AssertionError(f'Spilled packet {i} does not match!')
+    if len(printing.window) > WINDOW_BYTES:
+        raise AssertionError('Window grew past WINDOW_BYTES!')
+    # bands of a tall page end well past row 255
+    num_rows = (printing.page_end - printing.page_start) * ROWS_PER_PACKET
+    whole = printing.band_hash(0, num_rows, 1)
+    if whole == printing.band_hash(16, num_rows, 1):
+        raise AssertionError('Tall bands hash the same!')
+    printing.finish_job()
+    print(f'{num_packets} packets spilled to flash and read back')
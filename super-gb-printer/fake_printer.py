@@ -0,0 +1,290 @@
+"""FakePrinter class
+
+Stand-in for the POS printer on the other end of the serial link, for trying
+out POSLink without a printer. Answers the status and customization commands
+the way a TM-T88V does and ignores everything else.
+"""
+
+import io
+from micropython import const
+
+# stream ioctl used by uasyncio to poll, from MicroPython's stream.h
+MP_STREAM_POLL = const(3)
+POLL_RD = const(0x0001)
+POLL_WR = const(0x0004)
+
+DLE = const(16)
+GS = const(29)
+
+
+class FakePrinter(io.IOBase):
+    """Fake UART with a printer on the other end.
+
+    Can be given to POSLink in place of its UART. Bytes sent either way
+    while the two ends are at different baud rates are lost, like they'd be
+    garbled on a real link, as is everything above the fastest rate the
+    link can carry. Replies can be given a lower limit than that, like a
+    long RX wire.
+    """
+
+    def __init__(
+            self,
+            baudrate: int = 115200,
+            supported_rates: tuple = (9600, 19200, 38400, 57600, 115200),
+            max_link_rate: int = 115200,
+            max_reply_rate: int = 0,
+            download_capacity: int = 384 * 1024,
+        ) -> None:
+        """Instantiate the class.
+
+        Args:
+            baudrate: Rate the printer is set to
+            supported_rates: Rates the printer will accept in its settings
+            max_link_rate: Fastest rate that makes it through the link
+            max_reply_rate: Fastest rate replies make it back at, if lower
+            download_capacity: Size of the download graphics area
+        """
+
+        self.baudrate = baudrate
+        self.uart_baudrate = baudrate
+        self.supported_rates = supported_rates
+        self.max_link_rate = max_link_rate
+        self.max_reply_rate = max_reply_rate or max_link_rate
+        self.download_capacity = download_capacity
+        # download graphics stored, keycode: size
+        self.stored = {}
+        self.new_baudrate = baudrate
+        self.user_setting = False
+        self.num_resets = 0
+        # DLE EOT n replies, all clear
+        self.status_bytes = {1: 0x16, 2: 0x12, 3: 0x12, 4: 0x12}
+        self.received = bytearray()
+        self.replies = bytearray()
+
+    def init(self, baudrate: int = 0, **kwargs) -> None:
+        """Change the baud rate of the Pico's end, like UART.init."""
+
+        if baudrate:
+            self.uart_baudrate = baudrate
+
+    @property
+    def link_ok(self) -> bool:
+        """Whether bytes make it across the link right now."""
+
+        return (
+            self.uart_baudrate == self.baudrate
+            and self.baudrate <= self.max_link_rate
+        )
+
+    def write(self, data) -> int:
+        if self.link_ok:
+            self.received += data
+            self.parse()
+        return len(data)
+
+    def txdone(self) -> bool:
+        return True
+
+    def any(self) -> int:
+        return len(self.replies)
+
+    def readinto(self, buf) -> int:
+        n = min(len(buf), len(self.replies))
+        if not n:
+            return None
+        buf[:n] = self.replies[:n]
+        self.replies = self.replies[n:]
+        return n
+
+    def read(self, n: int = -1) -> bytes:
+        if n < 0:
+            n = len(self.replies)
+        buf = bytearray(n)
+        n = self.readinto(buf)
+        return bytes(buf[:n]) if n else None
+
+    def ioctl(self, req: int, arg: int) -> int:
+        if req != MP_STREAM_POLL:
+            return 0
+        ret = arg & POLL_WR
+        if self.replies:
+            ret |= arg & POLL_RD
+        return ret
+
+    def reply(self, data: bytes) -> None:
+        if self.link_ok and self.baudrate <= self.max_reply_rate:
+            self.replies += data
+
+    def parse(self) -> None:
+        """Handle every complete command received so far."""
+
+        while self.received:
+            length = self.parse_command(self.received)
+            if not length:
+                break
+            self.received = self.received[length:]
+
+    def parse_command(self, cmd: bytearray) -> int:
+        """Handle the command at the start of cmd.
+
+        Returns:
+            Number of bytes used, or 0 if the command isn't all here yet
+        """
+
+        if cmd[0] == DLE:
+            if len(cmd) < 3:
+                return 0
+            if cmd[1] == 4:
+                self.reply(bytes([self.status_bytes.get(cmd[2], 0x12)]))
+                return 3
+            return 1
+        if cmd[0] == GS:
+            if len(cmd) < 5:
+                return 0
+            if cmd[1] == 40:
+                start = 5
+                length = start + cmd[3] + cmd[4] * 256
+            elif cmd[1] == 56:
+                # GS 8, same as GS ( with a 4 byte length
+                if len(cmd) < 7:
+                    return 0
+                start = 7
+                length = start + int.from_bytes(cmd[3:7], 'little')
+            else:
+                return 1
+            if len(cmd) < length:
+                return 0
+            self.gs_paren(cmd[2], bytes(cmd[start:length]))
+            return length
+        # anything else is text or data, which is skipped
+        return 1
+
+    def gs_paren(self, kind: int, params: bytes) -> None:
+        """Handle GS ( commands, kind is the letter after the (."""
+
+        if not params:
+            return
+        fn = params[0]
+        if kind == ord('H') and fn == 48:
+            # process ID, everything's printed instantly
+            self.reply(bytes([0x37, 0x22]) + params[2:6] + bytes([0]))
+        if kind == ord('L') and len(params) > 1:
+            self.download_graphics(params[1], params)
+        if kind != ord('E'):
+            return
+        if fn == 1 and params[1:3] == b'IN':
+            self.user_setting = True
+            self.reply(bytes([0x37, 0x20, 0]))
+        elif fn == 2 and self.user_setting and params[1:4] == b'OUT':
+            # leaving the user setting mode resets the printer
+            self.user_setting = False
+            self.baudrate = self.new_baudrate
+            self.num_resets += 1
+            self.received = bytearray()
+        elif fn == 11 and self.user_setting and params[1] == 1:
+            rate = int(params[2:].decode())
+            if rate in self.supported_rates:
+                self.new_baudrate = rate
+        elif fn == 12 and self.user_setting and params[1] == 1:
+            digits = bytes(str(self.new_baudrate), 'utf-8')
+            self.reply(bytes([0x37, 0x33, 1, 0x1F]) + digits + bytes([0]))
+
+    def download_graphics(self, fn: int, params: bytes) -> None:
+        """Handle the GS ( L / GS 8 L commands for download graphics."""
+
+        remaining = self.download_capacity - sum(self.stored.values())
+        if fn == 52:
+            digits = bytes(str(remaining), 'utf-8')
+            self.reply(bytes([0x37, 0x32]) + digits + bytes([0]))
+        elif fn == 65 and params[2:5] == b'CLR':
+            self.stored = {}
+        elif fn == 66:
+            self.stored.pop(params[2:4], None)
+        elif fn == 83:
+            keycode = params[3:5]
+            size = len(params) - 2
+            remaining += self.stored.get(keycode, 0)
+            # a define that doesn't fit is ignored
+            if size <= remaining:
+                self.stored[keycode] = size
+
+
+if __name__ == "__main__":
+    # check the baud rate negotiation in POSLink against a few printers
+    import uasyncio as asyncio
+
+    import data_buffer
+    import pos_link
+    import printer_status
+
+    async def negotiate(printer: FakePrinter) -> int:
+        link = pos_link.POSLink(
+            data_buffer.DataBuffer(receive=False), uart=printer
+        )
+        await link.init_printer()
+        rate = await link.negotiate_baudrate()
+        if rate != printer.baudrate or rate != link.baudrate:
+            raise AssertionError('Link and printer rates differ!')
+        # still able to talk to it
+        if not await link.wait_printed():
+            raise AssertionError('Printer not answering!')
+        return rate
+
+    async def check():
+        fast = FakePrinter(
+            supported_rates=(115200, 230400), max_link_rate=230400
+        )
+        if await negotiate(fast) != 230400 or fast.num_resets != 1:
+            raise AssertionError('Did not go up to 230400!')
+
+        # set from a previous run, should be left at that
+        again = FakePrinter(
+            230400, supported_rates=(115200, 230400), max_link_rate=230400
+        )
+        if await negotiate(again) != 230400:
+            raise AssertionError('Did not find printer at 230400!')
+
+        # can't be heard at 460800, so it should come back down a step
+        deaf = FakePrinter(
+            supported_rates=(115200, 230400, 460800), max_link_rate=460800,
+            max_reply_rate=230400,
+        )
+        if await negotiate(deaf) != 230400:
+            raise AssertionError('Did not fall back to 230400!')
+
+        slow = FakePrinter()
+        if await negotiate(slow) != 115200:
+            raise AssertionError('Did not stay at 115200!')
+
+        default = FakePrinter(38400, max_link_rate=460800)
+        if await negotiate(default) != 38400:
+            raise AssertionError('Did not find printer at 38400!')
+
+        print('Baud rate negotiation checks passed')
+
+        big = FakePrinter()
+        link = pos_link.POSLink(
+            data_buffer.DataBuffer(receive=False), uart=big
+        )
+        await link.init_printer()
+        await link.query_status(printer_status.STATUS_PRINTER)
+        if await link.probe_download_capacity() != big.download_capacity:
+            raise AssertionError('Did not get the download capacity!')
+        if link.page_packets(3) != 9 or link.page_packets(1) != 72:
+            raise AssertionError('Wrong page sizes!')
+
+        # something stored behind the link's back gets cleared out
+        big.stored[b'ZZ'] = 1000
+        await link.check_download_area()
+        if big.stored:
+            raise AssertionError('Untracked download graphics not cleared!')
+        # and pages the printer lost are forgotten
+        link.keycode_size['GA'] = 1000
+        link.keycode_hash['GA'] = 1
+        await link.check_download_area()
+        if link.keycode_size or link.keycode_hash:
+            raise AssertionError('Lost download graphics not forgotten!')
+
+        print('Download capacity checks passed')
+
+    asyncio.run(check())
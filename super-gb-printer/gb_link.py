@@ -5,12 +5,13 @@ Contains methods that handle the connection to the Game Boy.
 
 import rp2
 import utime
-from machine import Pin
+from machine import Pin, mem32
 from micropython import const
 from ulab import numpy as np
 
 import data_buffer
 import pinout as pinn
+import ring_buffer
 import super_printer
 import utimeit
 
@@ -39,6 +40,27 @@ COMMAND_DATA = const(4)
 COMMAND_BREAK = const(8)
 COMMAND_STATUS = const(0xF)
 
+# status bit reported back when a packet fails its checksum, which makes the
+# Game Boy send it again
+STATUS_CHECKSUM_ERROR = const(0x01)
+
+# big enough to hold a full packet if the main loop falls behind
+RING_BUFFER_SIZE = const(1024)
+
+# registers used to capture payloads with DMA, see the RP2040 datasheet
+GB_LINK_SM = const(0)
+PIO0_BASE = const(0x50200000)
+PIO0_RXF0 = const(PIO0_BASE + 0x020)
+PIO0_IRQ = const(PIO0_BASE + 0x030)
+PIO0_INTE0 = const(PIO0_BASE + 0x12C)
+REG_ALIAS_SET = const(0x2000)
+REG_ALIAS_CLR = const(0x3000)
+DREQ_PIO0_RX0 = const(4)
+# the PIO program raises IRQ flag rel(0), which shows up at bit 8 + flag
+# in INTE0
+GB_LINK_IRQ_FLAG = const(1 << GB_LINK_SM)
+GB_LINK_IRQ_BIT = const(GB_LINK_IRQ_FLAG << 8)
+
 # PIO program for interacing with Game Boy
 @rp2.asm_pio(
     in_shiftdir=rp2.PIO.SHIFT_LEFT,
@@ -47,10 +69,11 @@ COMMAND_STATUS = const(0xF)
     out_init=rp2.PIO.OUT_LOW,
 )
 def gb_link_pio():
-    set(x, 6)             # set loop to run 6 + 1 times
+    set(x, 0)             # byte sent if TX FIFO is empty, see pull below
+    set(y, 6)             # set loop to run 6 + 1 times
     wait(0, gpio, 2)      # wait for falling edge
     set(pins, 1)          # byte started, turn on LED
-    pull(noblock)         # pull value from TX FIFO to OSR
+    pull(noblock)         # pull value from TX FIFO to OSR (or x if empty)
     out(null, 24)         # shift left by 24, keeping 8 bits of desired data
     out(pins, 1)          # out the MSB bit in OSR to GB
     wait(1, gpio, 2)[2]   # wait for rising edge
@@ -59,7 +82,7 @@ def gb_link_pio():
     wait(0, gpio, 2)[2]   # wait for falling edge
     out(pins, 1)          # output the next bit from OSR to GB
     wait(1, gpio, 2)[1]   # wait for rising edge
-    jmp(x_dec, "loop")    # loop through the rest of the bits
+    jmp(y_dec, "loop")    # loop through the rest of the bits
     in_(pins, 1)          # input last bit from GB
     push(noblock)         # push the received value from ISR to RX FIFO
     irq(rel(0))           # set interrupt
@@ -70,19 +93,30 @@ class GBLink:
 
     def __init__(
             self,
-            parent: super_printer.SuperPrinter
+            parent: super_printer.SuperPrinter,
+            ring_mode: bool = True,
+            dma_payload: bool = True,
         ):
         """Instantiate the class.
         
         Args:
             parent: The Parent SuperPrinter object.
+            ring_mode: 
+                If True, the IRQ only stores bytes in a ring buffer and the
+                packets are parsed in the main loop. If False, the whole
+                packet state machine runs inside the IRQ.
+            dma_payload:
+                If True (and in ring mode), the payload of DATA packets is
+                written straight into the data buffer by DMA, with the IRQ
+                switched off until it's done.
         """
         self.parent = parent
         self.btn = self.parent.btn
         self.data_buffer = self.parent.data_buffer
-        self.lcd = self.parent.lcd
+        # the LCD belongs to the other core, so messages get passed along
+        self.lcd_message = ''
         self.pio_mach = rp2.StateMachine(
-            0, gb_link_pio, 
+            GB_LINK_SM, gb_link_pio, 
             in_base=Pin(pinn.GB_IN),
             out_base=Pin(pinn.GB_OUT),
             set_base=Pin(pinn.GB_LED_ACTIVITY),
@@ -92,22 +126,42 @@ class GBLink:
         self.packet_state = STATE_IDLE
         self.remaining_bytes = 0
         self.packet = data_buffer.GBPacket()
+        self.ring_mode = ring_mode
+        self.dma_payload = ring_mode and dma_payload
+        self.rx_ring = ring_buffer.ByteRingBuffer(RING_BUFFER_SIZE)
+        self.header_complete = False
         self.byte_received = False
         self.complete_packet = False
         self.rx_byte = 0
         self.tx_byte = 0
         self.printer_status = 0
+        # status byte queued in the ring for the packet being received
+        self.queued_status = 0
         self.end_of_print_data = False
+        # margin byte of the last PRINT command, before in the upper nibble
+        # and after in the lower one, and its palette and exposure bytes
+        self.print_margins = 0
+        self.print_palette = 0xE4
+        self.print_exposure = 0x40
         self.last_packet_time = utime.ticks_ms()
         self.fake_print_ticks = 0
         self.send_early_status_byte = True
+        self.checksum_errors = 0
+        self.magic_errors = 0
+        # replies queued after their slot had gone out, so the Game Boy got
+        # 0x00 instead
+        self.late_replies = 0
 
     def startup(self) -> None:
         """Initialize the GB link."""
 
         self.pio_enabled_led.off()
         # Pin(pinn.GB_LED_ACTIVITY, Pin.OUT).off()
-        self.pio_mach.irq(self.gb_interrupt)
+        if self.ring_mode:
+            self.pio_mach.irq(self.gb_interrupt_ring, hard=True)
+            self.data_buffer.rx_dma.irq(self.payload_dma_done, hard=True)
+        else:
+            self.pio_mach.irq(self.gb_interrupt)
         self.shutdown_pio_mach()
         self.startup_pio_mach(keep_message=True)
         print('gb link ready!')
@@ -118,6 +172,7 @@ class GBLink:
         print('Shutting down PIO')
         self.pio_mach.active(0)
         self.pio_enabled_led.off()
+        self.data_buffer.rx_dma.active(0)
         while self.pio_mach.rx_fifo():
             print('Draining RX FIFO')
             _ = self.pio_mach.get()
@@ -132,10 +187,14 @@ class GBLink:
         print('Starting PIO')
         self.pio_mach.restart()
         self.pio_enabled_led.on()
+        # only safe to reset the ring while the IRQ can't fire
+        self.rx_ring.clear()
         self.initialize_emu_printer()
         if not keep_message:
-            self.lcd.clear()
-            self.lcd.print("Ready")
+            self.lcd_message = "Ready"
+        # IRQ may have been left off by an unfinished payload capture
+        mem32[PIO0_IRQ] = GB_LINK_IRQ_FLAG
+        mem32[PIO0_INTE0 | REG_ALIAS_SET] = GB_LINK_IRQ_BIT
         self.pio_mach.active(1)
         self.pio_mach.put(0)
         self.last_packet_time = utime.ticks_ms()
@@ -155,37 +214,38 @@ class GBLink:
         """Resets states/buffers related to the emulated printer."""
 
         self.packet_state = STATE_IDLE
+        self.header_complete = False
         self.printer_status = 0x00
+        self.end_of_print_data = False
         self.data_buffer.clear_packets()
     
-    def check_print_ready(self) -> bool:
-        """Checks if a print is ready to start.
+    def take_finished_print(self) -> bool:
+        """Checks if the data for a print has all come in.
 
-        Check succeeds if a print command packet has been received from the
-        Game Boy and at least one second has passed since the last incoming
-        packet, to ensure the Game Boy is no longer sending status commands
-        during the fake print period (see check_handle_packet). 
+        Called when there's room in the job queue for a new job. Until
+        then, the emulated printer stays busy (see handle_packet) so the
+        Game Boy waits for it. Once taken, the fake print is let run out.
 
         Returns:
-            True or False if print is (not) ready.
+            True if there's a finished print to take from the data buffer
         """
-        this_time = utime.ticks_ms()
-        if (
-            utime.ticks_diff(this_time, self.last_packet_time) > 1000
-            and self.end_of_print_data
-        ):
+        if self.end_of_print_data:
             self.end_of_print_data = False
             return True
         return False
 
     def gb_interrupt(self, pio_mach: rp2.StateMachine) -> None:
-        """IRQ handler for incoming byte on the GB link PIO."""
+        """IRQ handler for incoming byte on the GB link PIO.
+        
+        Used when ring mode is off. Runs the whole packet state machine
+        inside the IRQ.
+        """
 
         if pio_mach.rx_fifo():
             self.rx_byte = pio_mach.get()
         else:
             print('no RX FIFO byte!')
-            self.rx_ryte = 0
+            self.rx_byte = 0
         
         # This delay forces the timing of sending TX bytes to the Game Boy
         # to drift one byte. Without it, the timing of bytes compared to when
@@ -194,33 +254,124 @@ class GBLink:
         # error.
         utime.sleep_us(50)
 
+        self.tx_byte = self.parse_byte(self.rx_byte)
+        self.pio_mach.put(self.tx_byte)
+
+    def gb_interrupt_ring(self, pio_mach: rp2.StateMachine) -> None:
+        """Hard IRQ handler for incoming byte on the GB link PIO.
+        
+        Used in ring mode. Only moves the byte into the ring buffer and hands
+        the reply byte that the main loop queued up to the PIO. All parsing
+        happens in check_handle_packet.
+        """
+
+        if pio_mach.rx_fifo():
+            pio_mach.put(self.rx_ring.put(pio_mach.get()))
+
+    def payload_dma_done(self, dma: rp2.DMA) -> None:
+        """Hard IRQ handler for the end of a payload capture.
+
+        Runs right after the last payload byte lands in the data buffer,
+        well before the first checksum byte has finished clocking in. Queues
+        the reply bytes for the rest of the packet and turns the PIO IRQ
+        back on.
+        """
+
+        ring = self.rx_ring
+        # the next byte into the ring is the first checksum byte
+        ring.tx[(ring.head + 1) & ring.mask] = 0x81
+        ring.tx[(ring.head + 2) & ring.mask] = self.printer_status
+        self.queued_status = self.printer_status
+        # clear the flag left over from the last payload byte
+        mem32[PIO0_IRQ] = GB_LINK_IRQ_FLAG
+        mem32[PIO0_INTE0 | REG_ALIAS_SET] = GB_LINK_IRQ_BIT
+
+    def start_payload_dma(self) -> bool:
+        """Hand the rest of a DATA packet payload over to DMA.
+
+        Called from the main loop right after the header is parsed. The
+        PIO IRQ is switched off first so the ring stops growing, then any
+        payload bytes that made it into the ring are copied to the data
+        buffer and DMA picks up the rest from the RX FIFO, which holds a
+        few bytes while this runs.
+
+        Returns:
+            False if the whole payload was already in the ring, in which
+            case the IRQ is back on and parsing carries on as usual
+        """
+
+        mem32[PIO0_INTE0 | REG_ALIAS_CLR] = GB_LINK_IRQ_BIT
+        ring = self.rx_ring
+        length = self.packet.data_length
+        row = self.data_buffer.next_packet_space(length)
+        done = min(ring.available(), length)
+        for i in range(done):
+            row[i] = ring.get()
+        self.packet.dma_captured = True
+        self.packet_state = STATE_CHECKSUM
+        self.remaining_bytes = 2
+        if done < length:
+            self.data_buffer.capture_packet_dma(
+                PIO0_RXF0 + 4 * GB_LINK_SM,
+                DREQ_PIO0_RX0 + GB_LINK_SM,
+                done, length - done
+            )
+            return True
+
+        # main loop was slow and the whole payload is already here, so pick
+        # up anything that arrived while the IRQ was off and carry on
+        while self.pio_mach.rx_fifo():
+            ring.put(self.pio_mach.get())
+        mem32[PIO0_IRQ] = GB_LINK_IRQ_FLAG
+        mem32[PIO0_INTE0 | REG_ALIAS_SET] = GB_LINK_IRQ_BIT
+        return False
+
+    def parse_byte(self, rx_byte: int) -> int:
+        """Advance the packet state machine by one incoming byte.
+
+        Args:
+            rx_byte: Byte received from the Game Boy
+
+        Returns:
+            The byte to send back to the Game Boy when replying from inside
+            the IRQ (see gb_interrupt)
+        """
+
         # by default, send 0 byte back
-        self.tx_byte = 0x00
+        tx_byte = 0x00
 
         if self.packet_state == STATE_IDLE:
-            if self.rx_byte == 0x88:
+            if rx_byte == 0x88:
                 self.packet_state = STATE_MAGICBYTES_PARTIAL
             else:
                 print('First magic byte bad!')
+                self.magic_errors += 1
 
         elif self.packet_state == STATE_MAGICBYTES_PARTIAL:
-            if self.rx_byte == 0x33:
+            if rx_byte == 0x33:
                 self.packet_state = STATE_HEADER
                 self.remaining_bytes = 4
+                self.packet.calc_checksum = 0
+                # the reply is about this packet's checksum, not the last's
+                self.printer_status &= ~STATUS_CHECKSUM_ERROR
             else:
                 print('Second magic byte bad!')
+                self.magic_errors += 1
                 self.packet_state = STATE_IDLE
 
+        # checksum covers every byte from here up to the checksum itself
         elif self.packet_state == STATE_HEADER:
+            self.packet.calc_checksum += rx_byte
             self.remaining_bytes -= 1
             if self.remaining_bytes == 3:
-                self.packet.command = self.rx_byte
+                self.packet.command = rx_byte
             elif self.remaining_bytes == 2:
-                self.packet.compression_flag = self.rx_byte
+                self.packet.compression_flag = rx_byte
             elif self.remaining_bytes == 1:
-                self.packet.data_length = self.rx_byte
+                self.packet.data_length = rx_byte
             else:
-                self.packet.data_length += self.rx_byte * 256
+                self.packet.data_length += rx_byte * 256
+                self.header_complete = True
                 if self.packet.data_length:
                     self.packet_state = STATE_PAYLOAD
                     self.remaining_bytes = self.packet.data_length
@@ -231,7 +382,8 @@ class GBLink:
         elif self.packet_state == STATE_PAYLOAD:
             idx = self.packet.data_length - self.remaining_bytes
             self.remaining_bytes -= 1
-            self.packet.data[idx] = self.rx_byte
+            self.packet.data[idx] = rx_byte
+            self.packet.calc_checksum += rx_byte
             if self.remaining_bytes == 0:
                 self.packet_state = STATE_CHECKSUM
                 self.remaining_bytes = 2
@@ -241,53 +393,174 @@ class GBLink:
         elif self.packet_state == STATE_CHECKSUM:
             self.remaining_bytes -= 1
             if self.remaining_bytes == 1:
-                self.packet.checksum = self.rx_byte
+                self.packet.checksum = rx_byte
+                if self.packet.dma_captured:
+                    self.packet.calc_checksum += (
+                        self.data_buffer.payload_sum(self.packet.data_length)
+                    )
                 # can always send this here, desired if status byte is sent
                 # early and ignored by Game Boy if sent on time
-                self.tx_byte = 0x81 # first response byte
+                tx_byte = 0x81 # first response byte
             else:
-                self.packet.checksum += self.rx_byte * 256
+                self.packet.checksum += rx_byte * 256
                 self.packet_state = STATE_RESPONSE_READY
+                self.verify_checksum()
                 # where which byte gets sent matters
                 if self.send_early_status_byte:
-                    self.tx_byte = self.printer_status
+                    tx_byte = self.printer_status
                 else:
-                    self.tx_byte = 0x81
-                # self.tx_byte = 0x81
+                    tx_byte = 0x81
         
         elif self.packet_state == STATE_RESPONSE_READY:
             self.packet_state = STATE_RESPONSE_PARTIAL
             # can always send this here, desired if status byte is sent
             # on time and ignored by Game Boy if sent early
-            self.tx_byte = self.printer_status
+            tx_byte = self.printer_status
 
         elif self.packet_state == STATE_RESPONSE_PARTIAL:
             self.packet_state = STATE_IDLE
             self.complete_packet = True
-            # print(self.rx_byte, utime.ticks_us() - self.last_byte_time)
-            # self.last_byte_time = utime.ticks_us()
 
-        self.pio_mach.put(self.tx_byte)
-    
+        return tx_byte
+
+    def verify_checksum(self) -> None:
+        """Compare the received and calculated checksums.
+
+        Sets the checksum error status bit for a bad packet so the Game Boy
+        sends it again. It's cleared as each packet starts.
+        """
+
+        if self.packet.checksum_ok:
+            self.printer_status &= ~STATUS_CHECKSUM_ERROR
+        else:
+            self.checksum_errors += 1
+            self.printer_status |= STATUS_CHECKSUM_ERROR
+
+    @property
+    def between_packets(self) -> bool:
+        """Check if the link is idle with nothing waiting to be parsed."""
+        return (
+            self.packet_state == STATE_IDLE
+            and self.rx_ring.head == self.rx_ring.tail
+        )
+
+    @property
+    def emulating_print(self) -> bool:
+        """Check if the emulated printer is busy with a PRINT command.
+
+        The Game Boy doesn't send anything but STATUS packets then, so it's
+        the time for slow work like writing to flash, see
+        DataBuffer.spill_in_background.
+        """
+        return self.printer_status == 0x06
+
+    @property
+    def error_counts(self) -> dict:
+        """Get the counts of link errors seen since startup."""
+        return {
+            'checksum': self.checksum_errors,
+            'magic': self.magic_errors,
+            'overflow': self.rx_ring.overflows,
+            'late': self.late_replies,
+        }
+
+    def parse_ring(self) -> None:
+        """Parse every byte waiting in the ring buffer, handling packets.
+
+        The reply bytes for a packet are queued in the ring as soon as its
+        header has been parsed. The IRQ is fast enough that a byte queued
+        after byte N goes out while byte N+1 is clocked in, so the 0x81 is
+        queued on the second checksum byte and the status on the first
+        response byte.
+
+        The tightest case is a packet with no payload, like STATUS, whose
+        last header byte is only two bytes ahead of the second checksum
+        byte. Work between calls (background conversion and spilling) only
+        starts between packets, so it can start just before a packet's
+        first magic byte, which leaves it 7 byte times, about 7 ms at the
+        link's 8 kHz clock, before the replies are late. Replies that miss
+        their slot are counted in late_replies and logged.
+
+        The status queued with the header goes by the packets before, so
+        it's swapped once the checksum is checked if it turns out different.
+        """
+
+        ring = self.rx_ring
+        while ring.available():
+            position = ring.tail
+            self.parse_byte(ring.get())
+            if (
+                self.packet_state == STATE_RESPONSE_READY
+                and self.printer_status != self.queued_status
+            ):
+                # status was queued before the checksum could be checked,
+                # swap it for the final one if there's still time
+                self.queue_reply(position + 1, self.printer_status)
+                self.queued_status = self.printer_status
+            if self.header_complete:
+                # now it's known where the packet ends
+                self.header_complete = False
+                self.packet.dma_captured = False
+                if (
+                    self.dma_payload
+                    and self.packet.command == COMMAND_DATA
+                    and self.packet.data_length
+                    and self.start_payload_dma()
+                ):
+                    # ring stays empty until the capture is done
+                    return
+                ck_high = position + self.packet.data_length + 2
+                self.queue_reply(ck_high, 0x81)
+                self.queue_reply(ck_high + 1, self.printer_status)
+                self.queued_status = self.printer_status
+            if self.complete_packet:
+                self.handle_packet()
+
+    def queue_reply(self, position: int, tx_byte: int) -> None:
+        """Queue a reply byte in the ring, counting it if it's too late.
+
+        Args:
+            position: Byte counter value of the incoming byte to reply after
+            tx_byte: Byte to send back
+        """
+
+        if not self.rx_ring.set_reply(position, tx_byte):
+            self.late_replies += 1
+            print(f'Reply byte too late, link errors: {self.error_counts}')
+
     def check_handle_packet(self) -> None:
         """Check if there's a complete packet and handle it.
+
+        In ring mode, this parses everything the IRQ has stored since the
+        last call, handling each packet as it is completed.
+        """
+
+        if self.ring_mode:
+            self.parse_ring()
+        elif self.complete_packet:
+            self.handle_packet()
+
+    def handle_packet(self) -> None:
+        """Handle a complete packet.
         
-        Each command does the following things:
+        Packets that fail their checksum are dropped. Otherwise, each
+        command does the following things:
         INIT - 
-        DATA - Copies data from GBPacket to the data buffer
-        PRINT - Sets flag that print is ready and saves margin info. Starts
+        DATA - Copies data from GBPacket to the data buffer, or just
+            records it if the payload was captured there by DMA
+        PRINT - Sets flag that print is ready and saves margin, palette and
+            exposure info. Margins are kept for each PRINT in the job. Starts
             off a counter to make the Game Boy think a print is actually
-            occuring for a short time (actual printing is done after the link
-            is complete and the Game Boy thinks it's done).
+            occuring for a short time (actual printing is done on the other
+            core, against a copy of the data).
         BREAK - Same as INIT
         STATUS - Sends status info back to Game Boy. After a PRINT command,
             ticks down the fake printing counter, then sets status to a 
-            completed print when the counter reaches zero.  
+            completed print when the counter reaches zero. The counter only
+            starts once the print has been queued, so the printer shows as
+            busy while the job queue is full.
         """
 
-        if not self.complete_packet:
-            return
-     
         print(
             f'Packet type: {self.packet.command}, '
             f'Printer status: {self.printer_status}, '
@@ -295,7 +568,11 @@ class GBLink:
             f'Packet time: {utime.ticks_ms()}'
         )
 
-        if self.packet.command == COMMAND_INIT:
+        if not self.packet.checksum_ok:
+            # the Game Boy will send it again
+            print(f'Bad checksum, link errors: {self.error_counts}')
+
+        elif self.packet.command == COMMAND_INIT:
             # self.initialize_emu_printer()
             pass
 
@@ -304,16 +581,16 @@ class GBLink:
                 print('Received stop data packet')
             else:
                 self.data_buffer.copy_new_packet(self.packet)
-                pck = self.data_buffer.num_packets
-                cmp = bool(self.packet.compression_flag)
-                self.data_buffer.gb_compression_flag[pck] = cmp
                 self.printer_status = 0x08
 
         elif self.packet.command == COMMAND_PRINT:
             self.printer_status = 0x06
             pck = self.data_buffer.num_packets
-            self.lcd.clear()
-            self.lcd.print(f"Got {pck:02} packets")
+            self.lcd_message = f"Got {pck:02} packets"
+            self.print_margins = self.packet.data[1]
+            self.print_palette = self.packet.data[2]
+            self.print_exposure = self.packet.data[3]
+            self.data_buffer.print_breaks.append((pck, self.print_margins))
             if (self.packet.data[1] % 16) == 0:
                 print('This is not the end of a print!')
                 self.end_of_print_data = False
@@ -326,7 +603,13 @@ class GBLink:
             self.initialize_emu_printer()
             
         elif self.packet.command == COMMAND_STATUS:
-            if self.printer_status == 0x06:
+            # stay busy until the print side has taken the finished print,
+            # and until packets that need to go to flash are written
+            if (
+                self.printer_status == 0x06
+                and not self.end_of_print_data
+                and not self.data_buffer.spill_due
+            ):
                 self.fake_print_ticks -= 1
                 if self.fake_print_ticks == 0:
                     self.printer_status = 0x04
@@ -0,0 +1,316 @@
+"""JobArchive class
+
+Keeps the last few prints on the Pico's flash so they can be printed again
+from the button, without the Game Boy having to send them again.
+"""
+
+import os
+import struct
+import typing
+import uasyncio as asyncio
+from micropython import const
+
+import data_buffer
+from data_buffer import flash_lock
+
+# how many prints are kept, older ones are deleted
+ARCHIVE_MAX_JOBS = const(4)
+# each archived print is two files, arc<n>.idx with the settings and packet
+# index and arc<n>.bin with the packets just as they came in, laid out like
+# the job file of a print that was spilled to flash
+ARCHIVE_PREFIX = 'arc'
+INDEX_SUFFIX = '.idx'
+DATA_SUFFIX = '.bin'
+
+# magic, number of packets and PRINT commands, palette, exposure, zoom,
+# margins, bottom margin
+HEADER_FORMAT = '<4sHHBBBBB'
+HEADER_MAGIC = b'SGBJ'
+# end packet and margins of each PRINT command
+BREAK_FORMAT = '<HB'
+# offset, length and compression flag of each packet
+PACKET_FORMAT = '<IHB'
+
+# packet data is written this much at a time, waiting for the printer and
+# GB link to be idle in between
+WRITE_CHUNK = const(4096)
+IDLE_POLL_MS = const(200)
+
+
+class JobArchive():
+    """Saves finished prints to flash and loads them back as PrintJobs.
+
+    Saving is done by run, a task that only writes while busy says nothing
+    else is going on, since flash writes hold up both cores. A print that
+    was spilled to flash already has its packets in a file, which is just
+    renamed.
+    """
+
+    def __init__(
+            self,
+            on_release: typing.Optional[
+                typing.Callable[[data_buffer.PrintJob], None]
+            ] = None,
+        ) -> None:
+        """Instantiate the class, picking up prints saved before a reset.
+
+        Args:
+            on_release: Called with each job handed to add once it's no
+                longer held on to, saved or not
+        """
+
+        self.on_release = on_release
+        self.pending = None
+        self.flag = asyncio.ThreadSafeFlag()
+        # sequence numbers of saved prints, newest first
+        self.saved = []
+        # number of queued or printing reprints of each saved print, which
+        # mustn't be deleted from under them
+        self.in_use = {}
+        self.scan()
+        self.next_seq = self.saved[0] + 1 if self.saved else 0
+
+    def __len__(self) -> int:
+        return len(self.saved)
+
+    @staticmethod
+    def paths(seq: int) -> tuple[str, str]:
+        """Get the index and data file names of a saved print."""
+
+        name = f'{ARCHIVE_PREFIX}{seq}'
+        return name + INDEX_SUFFIX, name + DATA_SUFFIX
+
+    def scan(self) -> None:
+        """Find the saved prints, deleting any that weren't finished."""
+
+        with flash_lock:
+            names = os.listdir()
+        for name in names:
+            if not name.startswith(ARCHIVE_PREFIX):
+                continue
+            seq = name[len(ARCHIVE_PREFIX):].split('.')[0]
+            try:
+                seq = int(seq)
+            except ValueError:
+                continue
+            index_path, data_path = self.paths(seq)
+            if index_path in names and data_path in names:
+                if seq not in self.saved:
+                    self.saved.append(seq)
+            else:
+                # the index is written last, so the print didn't make it
+                self.remove(seq)
+        self.saved.sort(reverse=True)
+
+    def add(self, job: data_buffer.PrintJob) -> None:
+        """Hand over a printed job to be saved by run.
+
+        Only the latest job waits to be saved. If another one was still
+        waiting, it's forgotten, along with its job file.
+
+        Args:
+            job: The job, after it's been printed
+        """
+
+        if self.pending is not None:
+            if self.pending.job_path:
+                with flash_lock:
+                    os.remove(self.pending.job_path)
+            self.release(self.pending)
+        self.pending = job
+        self.flag.set()
+
+    async def run(self, busy: typing.Callable[[], bool]) -> None:
+        """Save jobs handed over by add forever.
+
+        Args:
+            busy: Returns True while the flash shouldn't be written to
+        """
+
+        while True:
+            while self.pending is None:
+                await self.flag.wait()
+            job = self.pending
+            try:
+                await self.save(job, busy)
+            except OSError as e:
+                # most likely out of space, it's only the archive
+                print(f'Could not archive print: {e}')
+                if job.job_path:
+                    # don't leave it lying around under a job file name
+                    with flash_lock:
+                        try:
+                            os.remove(job.job_path)
+                        except OSError:
+                            pass
+                    job.job_path = None
+            if self.pending is job:
+                self.pending = None
+                self.release(job)
+
+    def release(self, job: data_buffer.PrintJob) -> None:
+        """Let go of a job handed to add, see on_release."""
+
+        if self.on_release is not None:
+            self.on_release(job)
+
+    async def save(
+            self, job: data_buffer.PrintJob, busy: typing.Callable[[], bool]
+        ) -> None:
+        """Write a job out to flash, a chunk at a time when not busy.
+
+        Args:
+            job: The job to save
+            busy: Returns True while the flash shouldn't be written to
+        """
+
+        seq = self.next_seq
+        self.next_seq += 1
+        index_path, data_path = self.paths(seq)
+        if not await self.wait_idle(job, busy):
+            return
+        if job.job_path:
+            with flash_lock:
+                os.rename(job.job_path, data_path)
+            job.job_path = None
+        else:
+            with flash_lock:
+                f = open(data_path, 'wb')
+            try:
+                for start in range(0, len(job.arena), WRITE_CHUNK):
+                    if not await self.wait_idle(job, busy):
+                        break
+                    chunk = memoryview(job.arena)[start:start+WRITE_CHUNK]
+                    with flash_lock:
+                        f.write(chunk)
+            finally:
+                with flash_lock:
+                    f.close()
+
+        if not await self.wait_idle(job, busy):
+            self.remove(seq)
+            return
+        with flash_lock:
+            with open(index_path, 'wb') as f:
+                f.write(self.pack_index(job))
+        self.saved.insert(0, seq)
+        self.trim()
+        print(f'Archived print {seq}, {len(self.saved)} saved')
+
+    async def wait_idle(
+            self, job: data_buffer.PrintJob, busy: typing.Callable[[], bool]
+        ) -> bool:
+        """Wait until the flash can be written to.
+
+        Returns:
+            False if a newer job came along in the meantime, in which case
+            that one's saved instead
+        """
+
+        while busy() and self.pending is job:
+            await asyncio.sleep_ms(IDLE_POLL_MS)
+        return self.pending is job
+
+    @staticmethod
+    def pack_index(job: data_buffer.PrintJob) -> bytes:
+        """Pack the settings and packet index of a job into bytes."""
+
+        index = bytearray(struct.pack(
+            HEADER_FORMAT, HEADER_MAGIC, job.num_packets,
+            len(job.print_breaks), job.palette, job.exposure, job.zoom,
+            job.margins, int(job.add_bottom_margin),
+        ))
+        for end, margins in job.print_breaks:
+            index += struct.pack(BREAK_FORMAT, end, margins)
+        for idx in range(job.num_packets):
+            index += struct.pack(
+                PACKET_FORMAT, job.packet_offset[idx], job.data_length[idx],
+                int(job.gb_compression_flag[idx]),
+            )
+        return index
+
+    def trim(self) -> None:
+        """Delete the oldest saved prints over ARCHIVE_MAX_JOBS."""
+
+        for seq in self.saved[ARCHIVE_MAX_JOBS:]:
+            if not self.in_use.get(seq):
+                self.saved.remove(seq)
+                self.remove(seq)
+
+    @staticmethod
+    def remove(seq: int) -> None:
+        """Delete the files of a saved print, whichever of them exist."""
+
+        with flash_lock:
+            for path in JobArchive.paths(seq):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def load(self, n: int) -> data_buffer.PrintJob:
+        """Make a PrintJob to print a saved print again.
+
+        The packets stay on flash and are streamed back from there like a
+        spilled print's. Call done once it's printed.
+
+        Args:
+            n: Which saved print, 0 is the newest
+
+        Returns:
+            The PrintJob, with the settings it was printed with
+        """
+
+        seq = self.saved[n]
+        index_path, data_path = self.paths(seq)
+        with flash_lock:
+            with open(index_path, 'rb') as f:
+                index = f.read()
+            data_bytes = os.stat(data_path)[6]
+        (
+            magic, num_packets, num_breaks, palette, exposure, zoom,
+            margins, add_bottom_margin
+        ) = struct.unpack_from(HEADER_FORMAT, index)
+        if magic != HEADER_MAGIC:
+            raise ValueError('Archived print is corrupt!')
+        pos = struct.calcsize(HEADER_FORMAT)
+        print_breaks = []
+        for _ in range(num_breaks):
+            print_breaks.append(struct.unpack_from(BREAK_FORMAT, index, pos))
+            pos += struct.calcsize(BREAK_FORMAT)
+        packet_offset = []
+        data_length = []
+        gb_compression_flag = []
+        for _ in range(num_packets):
+            offset, length, flag = struct.unpack_from(
+                PACKET_FORMAT, index, pos
+            )
+            packet_offset.append(offset)
+            data_length.append(length)
+            gb_compression_flag.append(bool(flag))
+            pos += struct.calcsize(PACKET_FORMAT)
+
+        job = data_buffer.PrintJob(
+            b'', packet_offset, gb_compression_flag, data_length
+        )
+        job.job_path = data_path
+        job.spilled_bytes = data_bytes
+        job.keep_job_file = True
+        job.archive_seq = seq
+        job.print_breaks = print_breaks
+        job.palette = palette
+        job.exposure = exposure
+        job.zoom = zoom
+        job.margins = margins
+        job.add_bottom_margin = bool(add_bottom_margin)
+        self.in_use[seq] = self.in_use.get(seq, 0) + 1
+        return job
+
+    def done(self, job: data_buffer.PrintJob) -> None:
+        """Let go of a saved print once a reprint of it has printed."""
+
+        seq = job.archive_seq
+        self.in_use[seq] -= 1
+        if not self.in_use[seq]:
+            del self.in_use[seq]
+        self.trim()
@@ -0,0 +1,170 @@
+"""JobQueue class
+
+Holds finished prints waiting for the printer, so the Game Boy doesn't have
+to wait on paper while another print is going.
+"""
+
+import _thread
+import typing
+import uasyncio as asyncio
+from micropython import const
+
+import data_buffer
+
+# the most memory queued and printing jobs can take up between them
+QUEUE_MAX_BYTES = const(64 * 1024)
+QUEUE_MAX_JOBS = const(8)
+
+# what to do when a finished print doesn't fit in the queue
+# busy - the emulated printer stays busy, so the Game Boy waits until enough
+#     jobs have printed to make room. Nothing is ever lost.
+# drop oldest - queued jobs that haven't started printing are thrown away,
+#     oldest first, until the new one fits, and cleaned up by on_drop.
+POLICY_BUSY = const(0)
+POLICY_DROP_OLDEST = const(1)
+
+
+class JobQueue():
+    """FIFO queue of PrintJobs with a cap on the memory they use.
+
+    Jobs are added from the GB link thread on core 1 and taken by the print
+    task on core 0, so everything that touches the list holds a lock, and
+    checking for room and adding a job is done in one go by put_if_room. The
+    memory of a job, including the buffers the print side needs for it (see
+    DataBuffer.job_size), counts against the cap from the time it's queued
+    until done is called once it's printed. Whatever is still held after
+    that, like a job waiting to be archived, counts until release.
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = QUEUE_MAX_BYTES,
+            max_jobs: int = QUEUE_MAX_JOBS,
+            policy: int = POLICY_BUSY,
+            on_drop: typing.Optional[
+                typing.Callable[[data_buffer.PrintJob], None]
+            ] = None,
+        ) -> None:
+        """Instantiate the class.
+
+        Args:
+            max_bytes: Memory cap for the data of all jobs
+            max_jobs: Most jobs that can wait in the queue at once
+            policy: What to do when full, POLICY_BUSY or POLICY_DROP_OLDEST
+            on_drop: Called with each job that's dropped, to free its POS
+                buffer and job file like finishing a print does. Runs on
+                whichever core queued the job that made the room, and the
+                jobs are kept for take_dropped for anything else.
+        """
+
+        self.max_bytes = max_bytes
+        self.max_jobs = max_jobs
+        self.policy = policy
+        self.on_drop = on_drop
+        self.jobs = []
+        self.used_bytes = 0
+        self.num_printing = 0
+        self.num_dropped = 0
+        # dropped jobs waiting for take_dropped
+        self.dropped = []
+        self.lock = _thread.allocate_lock()
+        self.flag = asyncio.ThreadSafeFlag()
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def put_if_room(
+            self,
+            num_bytes: int,
+            make_job: typing.Callable[
+                [], typing.Optional[data_buffer.PrintJob]
+            ],
+        ) -> bool:
+        """Add a job to the end of the queue if there's room for it.
+
+        Drops old jobs to make room if the policy allows it. A job always
+        fits if nothing else is queued or printing, so one that's bigger
+        than the cap can still be printed on its own.
+
+        The check and the put happen under the lock, so the print task
+        can't take or finish a job in between. That means the job is only
+        made once it's known to fit.
+
+        Args:
+            num_bytes: Size of the job, see DataBuffer.job_size
+            make_job: Makes the job, or returns None if there's nothing to
+                queue after all
+
+        Returns:
+            True if a job was queued
+        """
+
+        dropped = []
+        job = None
+        with self.lock:
+            if self.policy == POLICY_DROP_OLDEST:
+                while self.jobs and not self._fits(num_bytes):
+                    old = self.jobs.pop(0)
+                    self.used_bytes -= old.num_bytes
+                    self.num_dropped += 1
+                    dropped.append(old)
+                    self.dropped.append(old)
+                    print(f'Queue full, dropped a job of {old.num_bytes}')
+            if self._fits(num_bytes):
+                job = make_job()
+                if job is not None:
+                    self.jobs.append(job)
+                    self.used_bytes += job.num_bytes
+        # cleaning up can mean deleting files, so not while holding the lock
+        if self.on_drop is not None:
+            for old in dropped:
+                self.on_drop(old)
+        if job is None:
+            return False
+        self.flag.set()
+        return True
+
+    def _fits(self, num_bytes: int) -> bool:
+        if not self.jobs and not self.num_printing:
+            return True
+        return (
+            len(self.jobs) < self.max_jobs
+            and self.used_bytes + num_bytes <= self.max_bytes
+        )
+
+    async def get(self) -> data_buffer.PrintJob:
+        """Wait for the oldest job and take it off the queue."""
+
+        while True:
+            with self.lock:
+                if self.jobs:
+                    self.num_printing += 1
+                    return self.jobs.pop(0)
+            await self.flag.wait()
+
+    def done(self, job: data_buffer.PrintJob, held_bytes: int = 0) -> None:
+        """Free up the memory of a job that has finished printing.
+
+        Args:
+            job: The job
+            held_bytes: Memory the job still holds, which counts against the
+                cap until release is called with it
+        """
+
+        with self.lock:
+            self.used_bytes -= job.num_bytes - held_bytes
+            self.num_printing -= 1
+
+    def release(self, num_bytes: int) -> None:
+        """Free up memory held on to after done."""
+
+        with self.lock:
+            self.used_bytes -= num_bytes
+
+    def take_dropped(self) -> list[data_buffer.PrintJob]:
+        """Get the jobs dropped since the last call."""
+
+        with self.lock:
+            dropped = self.dropped
+            self.dropped = []
+        return dropped
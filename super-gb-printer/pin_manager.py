@@ -43,6 +43,15 @@ class PinManager():
         """Sets whether the print is not scaled."""
         return self.dip_switches[1].value()
     
+    @property
+    def zoom(self) -> int:
+        """Gets the zoom level set by the scale switches."""
+        if self.no_scale:
+            return 1
+        elif self.scale_2x:
+            return 2
+        return 3
+
     @property
     def add_bottom_margin(self):
         """Sets whether a bottom margin is added.
@@ -53,16 +62,19 @@ class PinManager():
         return self.dip_switches[2].value()
     
     @property
-    def cut_mode(self):
-        """Sets whether the print is automatically cut.
-        
-        Disable it when printing custom banners, such as with Donkey Kong
-        Country (which isn't working right now).
+    def reprint_button(self) -> bool:
+        """Gets whether the reprint button is held down."""
+        return bool(self.buttons[0].value())
 
-        *****Currently unused*****
-        
+    @property
+    def copies(self) -> int:
+        """Gets the number of copies of each print, 1 to 4.
+
+        Set by switches 4 and 5 as a binary number, plus one.
         """
-        return self.dip_switches[3].value()
+        return (
+            1 + self.dip_switches[3].value() + 2 * self.dip_switches[4].value()
+        )
         
 
 
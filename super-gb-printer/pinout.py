@@ -12,6 +12,10 @@ GB_PIO_ENABLED = const(6)
 POS_UART = const(0)
 POS_TX = const(16)
 POS_RX = const(17)
+# printer DTR (busy line) through the RS232 converter, must be a CTS pin of
+# POS_UART. Set POS_USE_CTS to False if it's not connected.
+POS_CTS = const(18)
+POS_USE_CTS = const(False)
 POS_TX_ACTIVITY = const(8)
 
 LCD_I2C = const(1)
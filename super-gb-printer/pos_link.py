@@ -9,11 +9,20 @@ probably work too.
 Printing makes use of the download graphics buffer inside the printer. It's 
 large emough to hold 2 screens (18 packets, 36 tile rows) of graphics data 
 converted to the printer's graphics format at 3x zoom and multi-tone 
-(16 colors, but only 4 get used). 
+(16 colors, but only 4 get used), and a lot more below that, so pages are
+made as tall as the zoom allows while two still fit (see page_packets).
+They're stored under different keycodes in turn, so the next page can be
+uploaded while the last one is still printing. If everything in a print
+stays in the buffer at once, more copies of it can be printed without
+uploading it again, and pages that are already stored from an earlier print
+aren't uploaded at all. Older pages are deleted as new ones need the room,
+see make_download_room.
 """
 
+import rp2
+import uasyncio as asyncio
 import utime
-from machine import UART, Pin
+from machine import UART, Pin, mem32
 from micropython import const
 from typing import Optional, Union
 from ulab import numpy as np
@@ -22,17 +31,53 @@ import data_buffer
 import fake_lcd
 import lcd_i2c
 import pinout as pinn
+import printer_status
 import utimeit
 
 ROWS_PER_PACKET = const(16)
+# the rate the printer is expected to be set to, and fallen back to
+POS_BAUDRATE = const(115200)
+# rates the printer is looked for at on startup, fastest first. Rates above
+# POS_BAUDRATE are only used if the printer accepts them.
+POS_BAUDRATES = (460800, 230400, 115200, 57600, 38400, 19200, 9600)
+# how long the printer may take to come back after a reset, in ms
+PRINTER_RESET_TIME = const(5000)
+# without hardware flow control, the printer gets a rest after each write of
+# this percent of the time it took to go out over the wire
+PACE_PERCENT = const(10)
 
+# registers used to upload with DMA, see the RP2040 datasheet. Indexed by
+# the UART number.
+UART_BASES = (0x40034000, 0x40038000)
+DREQ_UART_TX = (20, 22)
+UART_DR = const(0x000)
+UART_FR = const(0x018)
+UART_DMACR = const(0x048)
+UART_FR_BUSY = const(1 << 3)
+UART_DMACR_TXDMAE = const(1 << 1)
+REG_ALIAS_SET = const(0x2000)
 
-def wait():
-    r"""Add a small wait time after a POS serial transmission.
-    
-    For some reason it makes the data connection more stable ¯\_ (ツ)_/¯
-    """
-    utime.sleep(.005)
+# keycodes pages are stored under in the download graphics area, used in turn
+DOWNLOAD_KEYCODES = ('GA', 'GB', 'GC', 'GD')
+# size of the download graphics area, fits two 9 packet pages at 3x. Used
+# if the printer doesn't say, see probe_download_capacity.
+DOWNLOAD_CAPACITY = const(256 * 1024)
+# bytes per stored page the printer may count on top of download_size, for
+# the define header and such, see check_download_area
+DOWNLOAD_SLACK = const(64)
+# tallest image uploaded at once, in dots, kept well inside what the define
+# command allows
+MAX_DOWNLOAD_ROWS = const(1152)
+# rough time the printer takes per row of dots, from the 150 ms per packet
+# the printer needed at 3x zoom. Only used if it doesn't answer status queries.
+PRINT_US_PER_ROW = const(3125)
+# how often to check on the printer while waiting on it, in ms
+STATUS_POLL_MS = const(500)
+
+# steps of a print kept by start_recording, see replay
+OP_FEED = const(0)
+OP_UPLOAD = const(1)
+OP_PRINT = const(2)
 
 
 class POSLink:
@@ -48,18 +93,84 @@ class POSLink:
             self, 
             buffer: Optional[data_buffer.DataBuffer] = None,
             lcd: AnyLCD = None,
+            flow_control: bool = pinn.POS_USE_CTS,
+            uart: Optional[UART] = None,
         ) -> None:
         """Instantiate the class.
         
         Args:
             buffer: DataBuffer instance
             lcd: LCD instance for an optional attached LCD screen
+            flow_control:
+                If True, the UART holds off sending while the printer's busy
+                line (wired to POS_CTS) says its buffer is full. Otherwise
+                writes are paced in software.
+            uart:
+                Stand-in for the printer's UART, like a FakePrinter. Graphics
+                data is then written to it rather than sent by DMA.
         """
 
         self.data_buffer = buffer if buffer else data_buffer.DataBuffer()
         self.lcd = lcd if lcd else fake_lcd.FakeLCD()
-        self.uart = UART(
-            0, baudrate=115200, tx=Pin(pinn.POS_TX), rx=Pin(pinn.POS_RX))
+        self.flow_control = flow_control
+        self.baudrate = POS_BAUDRATE
+        if uart:
+            self.uart = uart
+        elif flow_control:
+            self.uart = UART(
+                pinn.POS_UART, baudrate=POS_BAUDRATE, tx=Pin(pinn.POS_TX),
+                rx=Pin(pinn.POS_RX), cts=Pin(pinn.POS_CTS), flow=UART.CTS,
+            )
+        else:
+            self.uart = UART(
+                pinn.POS_UART, baudrate=POS_BAUDRATE, tx=Pin(pinn.POS_TX),
+                rx=Pin(pinn.POS_RX),
+            )
+        # time owed to the printer by software pacing, in us
+        self.pace_debt = 0
+        # everything sent to the printer so far, for reporting
+        self.bytes_sent = 0
+
+        # graphics data is uploaded from one of two buffers by DMA while the
+        # other is filled, see send_rows
+        self.tx_dma = None
+        if not uart:
+            uart_base = UART_BASES[pinn.POS_UART]
+            self.uart_dr = uart_base + UART_DR
+            self.uart_fr = uart_base + UART_FR
+            mem32[uart_base + UART_DMACR + REG_ALIAS_SET] = UART_DMACR_TXDMAE
+            self.tx_dma = rp2.DMA()
+            self.tx_dma_ctrl = self.tx_dma.pack_ctrl(
+                size = 0, inc_write = False,
+                treq_sel = DREQ_UART_TX[pinn.POS_UART],
+            )
+        self.upload_chunks = [bytearray(0), bytearray(0)]
+        self.upload_chunk_idx = 0
+        self.upload_total = 0
+        self.upload_start = 0
+
+        # keycode of the page last uploaded, and when each stored page should
+        # be done printing so its keycode can be reused
+        self.keycode = DOWNLOAD_KEYCODES[0]
+        self.keycode_idx = 0
+        self.keycode_rows = {}
+        self.keycode_free_at = {}
+        self.keycode_pid = {}
+        # bytes each keycode may be taking up in the download graphics area,
+        # see make_download_room
+        self.keycode_size = {}
+        # steps sent since start_recording, or None if not recording
+        self.recording = None
+        self.download_capacity = DOWNLOAD_CAPACITY
+        # keycode each page stored in the printer is under, by the page's
+        # hash, and the other way round, see send_data_buffer_to_download
+        self.page_cache = {}
+        self.keycode_hash = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # replies from the printer on the RX line
+        self.status = printer_status.PrinterStatus(self.uart)
         self.activity_led = Pin(pinn.POS_TX_ACTIVITY, Pin.OUT)
         self.zoomed_lut = {
             2: np.zeros((256, 2), dtype=np.uint8),
@@ -95,15 +206,335 @@ class POSLink:
         else:
             return (2**zoom) * POSLink.stretch(n // 2, zoom) + (n % 2)
 
+    async def write(self, data: Union[bytes, bytearray]) -> None:
+        """Send data to the printer and wait until it has gone out.
+
+        Other tasks keep running in the meantime. The wait starts with how
+        long the bytes should take at the baud rate, then polls the UART
+        until it's actually done, which takes longer if the printer is
+        holding CTS. Without hardware flow control, the printer also gets
+        a rest of PACE_PERCENT of the measured time, added up over writes
+        so short writes still count.
+
+        Args:
+            data: The bytes to send
+        """
+
+        await self.wait_upload()
+        t = utime.ticks_us()
+        self.bytes_sent += len(data)
+        self.uart.write(data)
+        # 10 bits per byte with start and stop bits
+        await asyncio.sleep_ms(len(data) * 10_000 // self.baudrate)
+        while not self.uart.txdone():
+            await asyncio.sleep_ms(0)
+        await self.pace(utime.ticks_diff(utime.ticks_us(), t))
+
+    async def pace(self, elapsed: int) -> None:
+        """Give the printer a rest if there's no hardware flow control.
+
+        Args:
+            elapsed: How long the last transfer took, in us
+        """
+
+        if self.flow_control:
+            return
+        self.pace_debt += elapsed * PACE_PERCENT // 100
+        if self.pace_debt >= 1000:
+            await asyncio.sleep_ms(self.pace_debt // 1000)
+            self.pace_debt %= 1000
+
+    def start_upload(self, chunk: bytearray, count: int) -> None:
+        """Start sending a buffer to the printer with DMA.
+
+        The transfer is paced by the UART TX FIFO (and CTS, if it's used),
+        so the CPU is free until it's done. Call wait_upload before touching
+        the buffer or the UART again.
+
+        Args:
+            chunk: The buffer to send
+            count: Number of bytes to send from the start of it
+        """
+
+        self.upload_total = count
+        self.upload_start = utime.ticks_us()
+        self.bytes_sent += count
+        self.activity_led.on()
+        self.tx_dma.config(
+            read = chunk,
+            write = self.uart_dr,
+            count = count,
+            ctrl = self.tx_dma_ctrl,
+            trigger = True
+        )
+
+    @property
+    def upload_progress(self) -> tuple[int, int]:
+        """Get the bytes sent so far and total bytes of the current upload."""
+
+        if not self.upload_total:
+            return 0, 0
+        return self.upload_total - self.tx_dma.count, self.upload_total
+
+    async def wait_upload(self) -> None:
+        """Wait until the current DMA upload, if any, is out on the wire."""
+
+        if not self.upload_total:
+            return
+        while self.tx_dma.active():
+            await asyncio.sleep_ms(1)
+        while mem32[self.uart_fr] & UART_FR_BUSY:
+            await asyncio.sleep_ms(0)
+        self.activity_led.off()
+        self.upload_total = 0
+        await self.pace(utime.ticks_diff(utime.ticks_us(), self.upload_start))
+
+    def next_upload_chunk(self, size: int) -> bytearray:
+        """Get the upload buffer that isn't being sent, at least size long."""
 
-    def init_printer(self) -> None:
-        """Send printer init command."""
+        self.upload_chunk_idx ^= 1
+        chunk = self.upload_chunks[self.upload_chunk_idx]
+        if len(chunk) < size:
+            chunk = bytearray(size)
+            self.upload_chunks[self.upload_chunk_idx] = chunk
+        return chunk
+
+
+    async def init_printer(self) -> None:
+        """Send printer init command.
+        
+        Also checks if the printer answers status queries, which decides
+        whether the status is used to know when it's done printing.
+        """
         self.activity_led.off()
+        self.clear_page_cache()
         #                      ESC  @
-        self.uart.write(bytes([27, 64]))
-        wait()
+        await self.write(bytes([27, 64]))
+        self.status.start()
+        await self.query_status(printer_status.STATUS_PRINTER)
+        print(f'Printer status available: {self.status.available}')
+
+    async def negotiate_baudrate(self) -> int:
+        """Find the printer's baud rate and raise it if the printer allows.
+
+        The printer is first looked for at POS_BAUDRATE, then each of
+        POS_BAUDRATES, since it may still be at a faster rate from a previous
+        run. If it's below the fastest rate, the faster rates are tried in
+        its serial settings using the customization commands (GS ( E), and
+        one that's accepted is kept after the printer resets. That's only
+        used if the printer then answers a status query at the new rate.
+        Otherwise, the printer goes back to the rate it was found at and the
+        next rate down is tried, until there are none left faster than the
+        rate it was found at, or POS_BAUDRATE.
+
+        The settings are kept in the printer's memory, so they're only
+        written when they change.
+
+        Returns:
+            The baud rate in use
+        """
+
+        # try the usual rate first, since bytes at the wrong rate can come
+        # out as junk on the paper
+        found = 0
+        probe_rates = [POS_BAUDRATE]
+        probe_rates += [x for x in POS_BAUDRATES if x != POS_BAUDRATE]
+        for rate in probe_rates:
+            self.set_uart_baudrate(rate)
+            if await self.query_status(printer_status.STATUS_PRINTER) >= 0:
+                found = rate
+                break
+        if not found:
+            print('Printer not answering, using default baud rate')
+            self.set_uart_baudrate(POS_BAUDRATE)
+            return self.baudrate
+        print(f'Found printer at {found} baud')
+        faster = [x for x in POS_BAUDRATES if x > max(found, POS_BAUDRATE)]
+        if not faster:
+            return found
+
+        while faster:
+            new_rate = await self.set_printer_baudrate(faster)
+            if not new_rate:
+                return found
+            self.set_uart_baudrate(new_rate)
+            if await self.wait_printer_reset():
+                print(f'Printer now at {new_rate} baud')
+                return new_rate
+
+            # the printer accepted the rate but can't be heard at it, so try
+            # to put it back before trying the next one down. Its replies
+            # won't make it either, so they're not waited for.
+            print(f'No answer at {new_rate} baud, going back to {found}')
+            await self.set_printer_baudrate([found], check=False)
+            self.set_uart_baudrate(found)
+            if not await self.wait_printer_reset():
+                print('Printer lost after changing baud rate!')
+                return found
+            faster = [x for x in faster if x < new_rate]
+        return found
+
+    def set_uart_baudrate(self, rate: int) -> None:
+        """Change the baud rate of this end of the link."""
+
+        self.uart.init(baudrate=rate)
+        self.baudrate = rate
+
+    async def set_printer_baudrate(
+            self, rates: list[int], check: bool = True
+        ) -> int:
+        """Set the first rate the printer accepts in its serial settings.
+
+        Leaving the user setting mode makes the printer reset, after which
+        it's at the new rate (or the same old one, if none were accepted).
+
+        Args:
+            rates: Baud rates to try, in order
+            check: If False, the printer's replies aren't waited for and the
+                first rate is just sent, for when they can't be heard
+
+        Returns:
+            The rate that was set, or 0 if none were accepted or the printer
+            didn't go into the user setting mode
+        """
+
+        responses = self.status.responses
+        # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_ce_fn01.html
+        responses.pop(printer_status.RESPONSE_USER_SETTING, None)
+        #                      GS   (   E  pL  pH  fn  d1  d2
+        await self.write(bytes([29, 40, 69, 3,  0,  1, 73, 78]))
+        if check and await self.status.wait_response(
+            printer_status.RESPONSE_USER_SETTING
+        ) is None:
+            return 0
+
+        new_rate = 0
+        for rate in rates:
+            digits = bytes(str(rate), 'utf-8')
+            pL = len(digits) + 2
+            # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_ce_fn11.html
+            #                      GS   (   E  pL  pH  fn  a
+            await self.write(bytes([29, 40, 69, pL, 0, 11, 1]) + digits)
+            if not check:
+                new_rate = rate
+                break
+            # read it back, it's left alone if the printer doesn't support it
+            responses.pop(printer_status.RESPONSE_SERIAL_CONFIG, None)
+            #                      GS   (   E  pL  pH  fn  a
+            await self.write(bytes([29, 40, 69, 2,  0, 12, 1]))
+            setting = await self.status.wait_response(
+                printer_status.RESPONSE_SERIAL_CONFIG
+            )
+            # the data is a, a separator, then the digits
+            if setting is not None and setting[2:] == digits:
+                new_rate = rate
+                break
+
+        # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_ce_fn02.html
+        #                      GS   (   E  pL  pH  fn  d1  d2  d3
+        await self.write(bytes([29, 40, 69, 4,  0,  2, 79, 85, 84]))
+        # the reset loses whatever was stored
+        self.clear_page_cache()
+        self.keycode_size = {}
+        return new_rate
+
+    async def wait_printer_reset(self) -> bool:
+        """Wait for the printer to answer status queries after a reset."""
+
+        t = utime.ticks_ms()
+        while utime.ticks_diff(utime.ticks_ms(), t) < PRINTER_RESET_TIME:
+            if await self.query_status(printer_status.STATUS_PRINTER) >= 0:
+                return True
+        return False
+
+    async def query_status(self, n: int) -> int:
+        """Get a real-time status byte, see PrinterStatus.query.
+
+        Waits for any upload first so the query isn't sent in the middle of
+        graphics data. If the printer doesn't answer, it may have been
+        turned off and on, so nothing stored in it is relied on after that.
+        """
+        await self.wait_upload()
+        status = await self.status.query(n)
+        if status < 0:
+            self.clear_page_cache()
+        return status
+
+    async def wait_ready(self) -> None:
+        """Wait while the printer can't print, e.g. out of paper.
+
+        The printer holds on to everything it's been sent, so the job picks
+        up where it left off once the problem is fixed. Does nothing if the
+        printer doesn't answer status queries.
+        """
+
+        paused = False
+        while self.status.available:
+            offline_cause = await self.query_status(
+                printer_status.STATUS_OFFLINE_CAUSE
+            )
+            paper = await self.query_status(printer_status.STATUS_PAPER)
+            if offline_cause < 0 or paper < 0:
+                break
+            message = printer_status.PrinterStatus.error_message(
+                offline_cause, paper
+            )
+            if not message:
+                break
+            if not paused:
+                print(f'Printer paused: {message}')
+                self.lcd.clear()
+                self.lcd.print(message)
+                self.lcd.set_cursor(0, 1)
+                self.lcd.print('Print paused')
+                paused = True
+            await asyncio.sleep_ms(STATUS_POLL_MS)
+        if paused:
+            print('Printer resumed')
+            self.lcd.clear()
+            self.lcd.print('Resuming print')
+
+    async def mark_printed(self) -> int:
+        """Ask the printer to say when it's printed everything so far.
+
+        Returns:
+            The process ID to wait on with wait_printed, or -1 if the printer
+            doesn't answer status queries
+        """
+
+        if not self.status.available:
+            return -1
+        pid = self.status.new_process_id()
+        # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_ch_fn48.html
+        #                      GS   (   H  pL  pH  fn   m
+        digits = bytes(f'{pid:04}', 'utf-8')
+        await self.write(bytes([29, 40, 72, 6,  0, 48, 48]) + digits)
+        return pid
+
+    async def wait_printed(self, pid: int = -1) -> bool:
+        """Wait until the printer has printed everything up to a point.
+
+        Pauses along with the printer if it runs out of paper and such, see
+        wait_ready.
+
+        Args:
+            pid: Process ID from mark_printed, or -1 to wait for everything
+                sent so far
+
+        Returns:
+            False if the printer doesn't answer status queries, so there was
+            no way to tell
+        """
+
+        if pid == -1:
+            pid = await self.mark_printed()
+        while self.status.available:
+            if await self.status.wait_printed(pid, STATUS_POLL_MS):
+                return True
+            await self.wait_ready()
+        return False
     
-    def set_justification(self, n: int) -> None:
+    async def set_justification(self, n: int) -> None:
         """Send printer alignment command.
         
         Args:
@@ -114,36 +545,413 @@ class POSLink:
         """
         # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/esc_la.html
         #                      ESC a  n
-        self.uart.write(bytes([27, 97, n]))
-        wait()
+        await self.write(bytes([27, 97, n]))
     
-    def print_text(self, text: str) -> None:
+    async def print_text(self, text: str) -> None:
         """Send text to the printer, then print command."""
 
         text_bytes = bytes(text, 'utf-8')
-        self.uart.write(text_bytes + bytes([10])) #append line feed
-        wait()
-        self.print()
+        await self.write(text_bytes + bytes([10])) #append line feed
+        await self.print()
 
-    def print(self):
+    async def print(self):
         """Send print command."""
         #                      GS  (   L   pL  pH   m  fn
-        self.uart.write(bytes([29, 40, 76,  2,  0, 48, 50]))
-        wait()
+        await self.write(bytes([29, 40, 76,  2,  0, 48, 50]))
     
-    @utimeit.timeit
-    def send_data_buffer_to_download(self, zoom: int = 3):
+    @utimeit.timeit_async
+    async def send_data_buffer_to_download(
+            self, zoom: int = 3, start_row: int = 0, end_row: int = -1
+        ):
         """Send portion of data buffer containing data to printer.
 
+        The rows are stored under the next keycode that has room (see
+        next_keycode), which is then kept in self.keycode for printing. If
+        the same rows are still stored from before, going by their hash,
+        nothing is sent and that keycode is used instead.
+
+        Args:
+            zoom: Zoom level of the image
+            start_row: First row of the current page to send
+            end_row: Last row of the current page to send plus one, or -1
+                for the end of the page
+        """
+
+        if end_row == -1:
+            buf = self.data_buffer
+            end_row = (buf.page_end - buf.page_start) * ROWS_PER_PACKET
+        num_rows = end_row - start_row
+        size = self.download_size(num_rows, zoom)
+        page_hash = self.data_buffer.band_hash(start_row, end_row, zoom)
+        keycode = self.page_cache.get(page_hash)
+        if keycode is not None:
+            self.cache_hits += 1
+            if self.recording is not None and not any(
+                op[0] == OP_UPLOAD and op[1] == keycode
+                for op in self.recording
+            ):
+                self.recording.append((OP_UPLOAD, keycode, size, page_hash))
+            self.keycode = keycode
+            return
+        self.cache_misses += 1
+
+        keycode = self.next_keycode(size)
+        if self.recording is not None:
+            self.recording.append((OP_UPLOAD, keycode, size, page_hash))
+        await self.wait_keycode_free(keycode)
+        await self.make_download_room(keycode, size)
+        await self.wait_ready()
+        self.keycode = keycode
+        self.forget_keycode(keycode)
+        if not self.data_buffer.page_in_pos_buffer:
+            await self.send_zoomed_download_graphics_data(
+                zoom, keycode, start_row, end_row
+            )
+        else:
+            buffer_slice = [
+                x[start_row:end_row,:] for x in self.data_buffer.pos_buffer
+            ]
+            await self.send_download_graphics_data(
+                buffer_slice, zoom, keycode=keycode
+            )
+        self.page_cache[page_hash] = keycode
+        self.keycode_hash[keycode] = page_hash
+        self.keycode_size[keycode] = size
+
+    def forget_keycode(self, keycode: str) -> None:
+        """Drop the page stored under a keycode from the page cache."""
+
+        page_hash = self.keycode_hash.pop(keycode, None)
+        if page_hash is not None:
+            self.page_cache.pop(page_hash, None)
+
+    def clear_page_cache(self) -> None:
+        """Forget every page stored in the printer."""
+
+        self.page_cache = {}
+        self.keycode_hash = {}
+
+    @staticmethod
+    def download_size(num_rows: int, zoom: int) -> int:
+        """Get the size some rows take up in the download graphics area.
+
+        Args:
+            num_rows: Number of rows of GB pixels
+            zoom: Zoom level of the image
+        """
+
+        phys_zoom = 1 if zoom < 3 else zoom
+        return (
+            4 * data_buffer.TILES_PER_BIG_ROW * phys_zoom
+            * num_rows * phys_zoom
+        )
+
+    async def feed(self, dots: int) -> None:
+        """Feed the paper by a number of dots, 1/180 inch each.
+
+        Used in place of printing blank rows, which would cost a lot more
+        data.
+        """
+
+        if self.recording is not None and dots > 0:
+            self.recording.append((OP_FEED, dots))
+        # motion units are 1/360 inch by default, see the cut method
+        units = dots * 2
+        while units > 0:
+            n = min(units, 255)
+            # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/esc_cj.html
+            #                      ESC  J  n
+            await self.write(bytes([27, 74, n]))
+            units -= n
+
+    def page_packets(self, zoom: int) -> int:
+        """Work out how many packets to put in a page at a zoom level.
+
+        As many as leave room for two pages in the download graphics area,
+        so one can upload while the other prints (see next_keycode), and no
+        taller than MAX_DOWNLOAD_ROWS, in whole screens where possible so
+        seams fall between them. At 3x, that's a screen. At 1x and 2x, where
+        the printer does the zooming, it's a lot more.
+
+        Goes by the whole area rather than what's left, since pages from
+        earlier prints are deleted to make room as each page is uploaded
+        (see make_download_room). They're only reused while they fit.
+
+        Args:
+            zoom: Zoom level of the print
+        """
+
+        phys_zoom = 1 if zoom < 3 else zoom
+        packet_size = self.download_size(ROWS_PER_PACKET, zoom)
+        fit = min(
+            self.download_capacity // (2 * packet_size),
+            MAX_DOWNLOAD_ROWS // (ROWS_PER_PACKET * phys_zoom),
+        )
+        if fit >= data_buffer.PACKETS_PER_SCREEN:
+            fit -= fit % data_buffer.PACKETS_PER_SCREEN
+        return max(fit, 1)
+
+    async def probe_download_capacity(self) -> int:
+        """Find out how big the printer's download graphics area is.
+
+        Everything stored there is deleted first, so the remaining capacity
+        the printer reports is all of it. That's done even if the printer
+        can't answer, so nothing left from before the Pico was reset takes
+        up room that isn't tracked. Stays at DOWNLOAD_CAPACITY if the
+        printer doesn't say.
+
+        Returns:
+            The capacity in bytes
+        """
+
+        await self.clear_download_area()
+        capacity = await self.query_download_space()
+        if capacity < 0:
+            print('Printer did not say its download capacity')
+            return self.download_capacity
+        if capacity > 0:
+            self.download_capacity = capacity
+        print(f'Download graphics capacity: {self.download_capacity}')
+        return self.download_capacity
+
+    async def query_download_space(self) -> int:
+        """Ask the printer how much of the download graphics area is left.
+
+        Returns:
+            The remaining capacity in bytes, or -1 if the printer doesn't say
+        """
+
+        if not self.status.available:
+            return -1
+        self.status.responses.pop(
+            printer_status.RESPONSE_DOWNLOAD_CAPACITY, None
+        )
+        # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_cl_fn52.html
+        #                      GS   (   L  pL  pH   m  fn
+        await self.write(bytes([29, 40, 76, 2,  0, 48, 52]))
+        data = await self.status.wait_response(
+            printer_status.RESPONSE_DOWNLOAD_CAPACITY
+        )
+        try:
+            return int(data.decode())
+        except (AttributeError, ValueError):
+            return -1
+
+    async def clear_download_area(self) -> None:
+        """Delete everything in the download graphics area.
+
+        Waits for the pages stored there to be printed first.
+        """
+
+        for keycode in DOWNLOAD_KEYCODES:
+            await self.wait_keycode_free(keycode)
+        # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_cl_fn65.html
+        #                      GS   (   L  pL  pH   m  fn  d1  d2  d3
+        await self.write(bytes([29, 40, 76, 5,  0, 48, 65, 67, 76, 82]))
+        self.clear_page_cache()
+        self.keycode_size = {}
+
+    async def check_download_area(self) -> None:
+        """Make sure what's stored in the printer is what's tracked.
+
+        Run before each print, since the pages are sized and the page cache
+        and make_download_room go by keycode_size. If the printer has less
+        room left than that says, something else is taking it up, so
+        everything is deleted. If it has more, the pages tracked aren't
+        there anymore, so they're forgotten. Without status, the clear in
+        probe_download_capacity is gone by.
+        """
+
+        remaining = await self.query_download_space()
+        if remaining < 0:
+            return
+        expected = self.download_capacity - sum(self.keycode_size.values())
+        slack = DOWNLOAD_SLACK * len(self.keycode_size)
+        if remaining < expected - slack:
+            print('Download graphics area has pages not tracked, clearing it')
+            await self.clear_download_area()
+        elif remaining > expected:
+            print('Pages stored in the printer are gone')
+            self.clear_page_cache()
+            self.keycode_size = {}
+
+    def start_recording(self) -> None:
+        """Start keeping track of the feeds, uploads and prints sent."""
+
+        self.recording = []
+
+    def stop_recording(self) -> list[tuple]:
+        """Stop keeping track and get what was sent since start_recording."""
+
+        recording = self.recording
+        self.recording = None
+        return recording
+
+    def resident(self, recording: list[tuple]) -> bool:
+        """Check if everything uploaded in a recording is still stored.
+
+        Each upload is recorded with the hash of its page, which has to
+        still be the one stored under its keycode. Anything uploaded over
+        it since, in this recording or after, deleted to make room or lost
+        to a printer reset fails that.
+        """
+
+        return all(
+            self.keycode_hash.get(op[1]) == op[3]
+            for op in recording if op[0] == OP_UPLOAD
+        )
+
+    async def replay(self, recording: list[tuple]) -> None:
+        """Print a recording again from what's stored in the printer.
+
+        Only the feeds and prints are sent, so check resident first.
+        """
+
+        for op in recording:
+            if op[0] == OP_FEED:
+                await self.feed(op[1])
+            elif op[0] == OP_PRINT:
+                await self.wait_ready()
+                await self.print_download_graphics_data(op[1], op[2], op[3])
+
+    def next_keycode(self, page_size: int) -> str:
+        """Pick the keycode to store the next page under.
+
+        Goes around as many keycodes as pages of this size fit in the
+        download graphics area at once, so uploading a page never overwrites
+        one that may still be printing unless there's only room for one.
+        Pages of other sizes left under the other keycodes are cleared out
+        of the way by make_download_room.
+
+        Args:
+            page_size: Size of the page, see download_size
+        """
+
+        num_keycodes = min(
+            len(DOWNLOAD_KEYCODES),
+            max(1, self.download_capacity // page_size),
+        )
+        self.keycode_idx = (self.keycode_idx + 1) % num_keycodes
+        return DOWNLOAD_KEYCODES[self.keycode_idx]
+
+    async def make_download_room(self, keycode: str, size: int) -> None:
+        """Delete stored pages until a new one fits in the download area.
+
+        The printer ignores a define that doesn't fit in what's left, so
+        pages under the other keycodes are deleted, oldest first, until it
+        does. Whatever is under the new page's own keycode is replaced by
+        the define.
+
+        Args:
+            keycode: Keycode the new page goes under
+            size: Size of the new page, see download_size
+        """
+
+        self.keycode_size.pop(keycode, None)
+        room = self.download_capacity - size
+        num_keycodes = len(DOWNLOAD_KEYCODES)
+        for i in range(1, num_keycodes):
+            if sum(self.keycode_size.values()) <= room:
+                return
+            # the keycode after the newest one was stored longest ago
+            old = DOWNLOAD_KEYCODES[(self.keycode_idx + i) % num_keycodes]
+            if old in self.keycode_size:
+                await self.delete_keycode(old)
+
+    async def delete_keycode(self, keycode: str) -> None:
+        """Delete the page stored under a keycode, once it's printed."""
+
+        await self.wait_keycode_free(keycode)
+        kc1, kc2 = [ord(x) for x in keycode]
+        # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_cl_fn66.html
+        #                      GS   (   L  pL  pH   m  fn
+        await self.write(bytes([29, 40, 76, 4,  0, 48, 66, kc1, kc2]))
+        self.keycode_size.pop(keycode, None)
+        self.forget_keycode(keycode)
+
+    async def wait_keycode_free(self, keycode: str) -> None:
+        """Wait until the page stored under a keycode has been printed.
+
+        Goes by the printer's status if it can, otherwise the print time
+        noted by print_download_graphics_data.
+        """
+
+        if keycode in self.keycode_pid:
+            pid = self.keycode_pid.pop(keycode)
+            if await self.wait_printed(pid):
+                self.keycode_free_at.pop(keycode, None)
+                return
+        if keycode not in self.keycode_free_at:
+            return
+        remaining = utime.ticks_diff(
+            self.keycode_free_at.pop(keycode), utime.ticks_ms()
+        )
+        if remaining > 0:
+            await asyncio.sleep_ms(remaining)
+
+    async def send_zoomed_download_graphics_data(
+        self, zoom: int, keycode: str, start_row: int, end_row: int
+    ):
+        """Send rows of the current page of the data buffer, converting as
+        it goes.
+
+        Each packet is converted, and zoomed at 3x and up, in one go just
+        before it's sent (see DataBuffer.zoomed_tone_rows), so the page never
+        needs to be in the POS buffer. Used for all pages at 3x and up, and
+        for pages at 1x and 2x too tall for the POS buffer.
+
         Args:
             zoom: Zoom level of the image
+            keycode: Code that the data is stored under inside printer
+            start_row: First row of the page to send
+            end_row: Last row of the page to send plus one
         """
 
-        slice_h = self.data_buffer.num_converted_packets * ROWS_PER_PACKET
-        buffer_slice = [x[:slice_h,:] for x in self.data_buffer.pos_buffer]
-        self.send_download_graphics_data(buffer_slice, zoom)
+        buf = self.data_buffer
+        # the printer zooms 2x itself, see send_download_graphics_data
+        phys_zoom = 1 if zoom < 3 else zoom
+        lut = self.zoomed_lut[phys_zoom] if phys_zoom > 1 else None
+        num_rows = end_row - start_row
+        self.keycode_rows[keycode] = num_rows * phys_zoom
+        await self.send_download_graphics_data_header(
+            data_buffer.TILES_PER_BIG_ROW * phys_zoom,
+            num_rows * phys_zoom,
+            keycode=keycode,
+        )
+        self.show_sending()
+
+        first_pkt = start_row // ROWS_PER_PACKET
+        last_pkt = (end_row - 1) // ROWS_PER_PACKET
+        num_packets = last_pkt - first_pkt + 1
+        for tone in range(4):
+            print(f"sending tone {tone}")
+            await self.send_tone_number(tone)
+            for i in range(first_pkt, last_pkt + 1):
+                n = i - first_pkt + tone * num_packets
+                self.lcd.set_cursor(8, 0)
+                self.lcd.print(f"{n:02}/{num_packets * 4:02}")
+                rows = buf.zoomed_tone_rows(buf.page_start + i, tone, lut)
+                # only part of the first and last packets may be wanted
+                pkt_row = i * ROWS_PER_PACKET
+                lo = max(start_row - pkt_row, 0)
+                hi = min(end_row - pkt_row, ROWS_PER_PACKET)
+                await self.send_rows(rows[lo:hi,:], phys_zoom)
+        await self.wait_upload()
+        print('done')
+
+    def show_sending(self) -> None:
+        """Tell everyone we're about to start sending data."""
+
+        print('Sending download data...')
+        self.lcd.clear()
+        self.lcd.print('Sending')
+        if self.data_buffer.num_pages > 1:
+            self.lcd.set_cursor(0, 1)
+            cp = self.data_buffer.current_page
+            nump = self.data_buffer.num_pages
+            self.lcd.print(f"Page {cp}/{nump}")
     
-    def send_download_graphics_data(
+    async def send_download_graphics_data(
         self, full_payload: list[np.ndarray], zoom_x: int = 1, 
         zoom_y: int = -1, keycode: str = 'GB', 
     ):
@@ -184,50 +992,61 @@ class POSLink:
         pos_zoom_y = 2 if zoom_y == 2 else 1
 
         # send header
-        self.send_download_graphics_data_header(
+        self.keycode_rows[keycode] = y * phys_zoom_y
+        await self.send_download_graphics_data_header(
             x * phys_zoom_x, y * phys_zoom_y, keycode=keycode
         )
 
-        # Tell everyone we're about to start sending data
-        print('Sending download data...')
-        self.lcd.clear()
-        self.lcd.print('Sending')
-        if self.data_buffer.num_pages > 1:
-            self.lcd.set_cursor(0, 1)
-            cp = self.data_buffer.current_page
-            nump = self.data_buffer.num_pages
-            self.lcd.print(f"Page {cp}/{nump}")
+        self.show_sending()
         
-        # start sending data
-        tile_row_buffer = np.zeros(x * phys_zoom_x, dtype=np.uint8)
+        # start sending data, a packet's worth of rows (16 px tall) at a time
         for i, tone_payload in enumerate(full_payload):
             print(f"sending tone {i}")
-            self.send_tone_number(i)
-            for row in range(y):
-                # update the LCD with each packet (16 px tall) processed
-                if not row % 16:
-                    n = (row + i * y) // 16
-                    d = y // 4
-                    self.lcd.set_cursor(8, 0)
-                    self.lcd.print(f"{n:02}/{d:02}")
+            await self.send_tone_number(i)
+            for row in range(0, y, ROWS_PER_PACKET):
+                # update the LCD with each packet processed
+                n = (row + i * y) // ROWS_PER_PACKET
+                d = y // 4
+                self.lcd.set_cursor(8, 0)
+                self.lcd.print(f"{n:02}/{d:02}")
+                rows = tone_payload[row:row+ROWS_PER_PACKET,:]
                 if phys_zoom_x >= 3:
-                    for px in range(x):
-                        # stretch each byte by amout of x-zoom
-                        tile_row_buffer[px*phys_zoom_x:(px+1)*phys_zoom_x] = (
-                            self.zoomed_lut[phys_zoom_x][tone_payload[row,px]]
-                        )
-                else:
-                    # if not zoomed, just send the row data
-                    tile_row_buffer = tone_payload[row,:]
-                self.activity_led.on()
-                for _ in range(phys_zoom_y):
-                    # need to send y times to create y-zoom
-                    self.uart.write(tile_row_buffer.tobytes())
-                    wait()
-                self.activity_led.off()
+                    # stretch each byte by amount of x-zoom all at once
+                    rows = data_buffer.zoom_rows(
+                        rows, self.zoomed_lut[phys_zoom_x]
+                    )
+                await self.send_rows(rows, phys_zoom_y)
+        await self.wait_upload()
         print('done')
 
-    def send_download_graphics_data_header(
+    async def send_rows(self, rows: np.ndarray, zoom_y: int = 1):
+        """Send rows of download graphics data, repeating each for y-zoom.
+
+        The rows are laid out along with their repeats in an upload buffer
+        and sent by DMA, so the next rows can be worked out while these are
+        still going out. Returns once the upload has started.
+
+        Args:
+            rows: 2D array of data, one row of dots per row
+            zoom_y: Number of times each row is sent
+        """
+
+        num_rows, width = rows.shape
+        count = num_rows * zoom_y * width
+        chunk = self.next_upload_chunk(count)
+        upload = np.frombuffer(chunk, dtype=np.uint8, count=count).reshape(
+            (num_rows * zoom_y, width)
+        )
+        for i in range(zoom_y):
+            # need to send y times to create y-zoom
+            upload[i::zoom_y, :] = rows
+        if self.tx_dma is None:
+            await self.write(memoryview(chunk)[:count])
+            return
+        await self.wait_upload()
+        self.start_upload(chunk, count)
+
+    async def send_download_graphics_data_header(
         self, x: int, y: int, num_tones: int = 4, keycode: str = 'GB'
     ):
         """Send the header portion of the send download graphics data command.
@@ -252,14 +1071,13 @@ class POSLink:
         yL = y % 256
         yH = y // 256
 
-        self.uart.write(bytes([
+        await self.write(bytes([
         # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_cl_fn83.html
         #   GS '8'  L   p1  p2  p3  p4  m   fn  a  kc1  kc2, b, xL, xH, yL, yH
             29, 56, 76, p1, p2, p3, p4, 48, 83, a, kc1, kc2, b, xL, xH, yL, yH
         ]))
-        wait()
     
-    def send_tone_number(self, tone: int):
+    async def send_tone_number(self, tone: int):
         """Send tone number, converted to range 49-52 as the printer likes.
 
         Run as part of a send download graphics data command.
@@ -273,10 +1091,9 @@ class POSLink:
             pass
         else:
             raise ValueError(f'Invalid tone value {tone}, must be 0-3 or 49-52')
-        self.uart.write(bytes([tone]))
-        wait()
+        await self.write(bytes([tone]))
     
-    def print_download_graphics_data(
+    async def print_download_graphics_data(
             self, zoom_x: int = 1, zoom_y: int = -1, keycode: str = 'GB'
         ):
         """Send the header portion of the send download graphics data command.
@@ -291,14 +1108,24 @@ class POSLink:
         
         x = 2 if zoom_x == 2 else 1
         y = 2 if zoom_y == 2 else 1
+        if self.recording is not None:
+            self.recording.append((OP_PRINT, zoom_x, zoom_y, keycode))
         
         kc1, kc2 = [ord(x) for x in keycode]
         # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_lparen_cl_fn85.html
         #                      GS   (  L   pL  pH   m  fn
-        self.uart.write(bytes([29, 40, 76,  6,  0, 48, 85, kc1, kc2, x, y]))
-        wait()
+        await self.write(bytes([29, 40, 76,  6,  0, 48, 85, kc1, kc2, x, y]))
+        # note when the printer will be done with it, for wait_keycode_free
+        pid = await self.mark_printed()
+        if pid >= 0:
+            self.keycode_pid[keycode] = pid
+            return
+        print_us = self.keycode_rows.get(keycode, 0) * y * PRINT_US_PER_ROW
+        self.keycode_free_at[keycode] = utime.ticks_add(
+            utime.ticks_ms(), print_us // 1000
+        )
 
-    def cut(self, feed_height: int = 0):
+    async def cut(self, feed_height: int = 0):
         """Send command to cut the paper.
         
         Args:
@@ -311,5 +1138,4 @@ class POSLink:
         """
         # https://download4.epson.biz/sec_pubs/pos/reference_en/escpos/gs_cv.html
         #                      GS  V   m   n
-        self.uart.write(bytes([29, 86, 65, feed_height]))
-        wait()
\ No newline at end of file
+        await self.write(bytes([29, 86, 65, feed_height]))
\ No newline at end of file
@@ -0,0 +1,233 @@
+"""PrinterStatus class
+
+Reads what the POS printer sends back on the UART RX line. Two kinds of
+replies are used:
+- Real-time status (DLE EOT), which the printer answers right away, even
+  while it's busy or offline. Tells if the cover is open or the paper ran out.
+- Process ID responses (GS ( H), which the printer only sends once everything
+  sent before the request has finished printing.
+Other replies that come as a block (header, ID, data, NUL), like the ones to
+the customization commands (GS ( E), are kept for whoever asked for them.
+"""
+
+import uasyncio as asyncio
+from machine import UART
+from micropython import const
+
+# DLE EOT n
+STATUS_PRINTER = const(1)
+STATUS_OFFLINE_CAUSE = const(2)
+STATUS_ERROR_CAUSE = const(3)
+STATUS_PAPER = const(4)
+
+# bits in the real-time status bytes
+PRINTER_OFFLINE = const(0x08)
+OFFLINE_COVER_OPEN = const(0x04)
+OFFLINE_PAPER_END = const(0x20)
+OFFLINE_ERROR = const(0x40)
+PAPER_NEAR_END = const(0x0C)
+PAPER_END = const(0x60)
+
+# real-time status bytes always have bits 1 and 4 set and bits 0 and 7 clear
+STATUS_FIXED_MASK = const(0x93)
+STATUS_FIXED_BITS = const(0x12)
+
+# block replies: header, ID, data, NUL
+RESPONSE_HEADER = const(0x37)
+RESPONSE_MAX_LENGTH = const(32)
+# IDs of the block replies used
+RESPONSE_USER_SETTING = const(0x20)
+RESPONSE_PROCESS_ID = const(0x22)
+RESPONSE_SERIAL_CONFIG = const(0x33)
+RESPONSE_DOWNLOAD_CAPACITY = const(0x32)
+
+# how long to wait for a real-time status reply before giving up, in ms
+STATUS_TIMEOUT = const(200)
+
+
+class PrinterStatus():
+    """Keeps track of replies from the printer.
+
+    run is started as a task and reads the RX line forever. Status queries
+    and process IDs are written to the UART by the caller (see POSLink), and
+    this class only matches up the replies. Status queries are answered in
+    the order they're sent, but only one is ever in flight here.
+    """
+
+    def __init__(self, uart: UART) -> None:
+        """Instantiate the class.
+
+        Args:
+            uart: The UART the printer is on
+        """
+
+        self.uart = uart
+        self.reader = asyncio.StreamReader(uart)
+        # False until the printer has answered a status query, in which case
+        # nothing here is used and callers fall back to guessing
+        self.available = False
+        self.last_status = 0
+        self.status_event = asyncio.Event()
+        self.status_lock = asyncio.Lock()
+        self.next_pid = 0
+        self.printed_pid = -1
+        self.printed_event = asyncio.Event()
+        # data of other block replies, by ID
+        self.responses = {}
+        self.response_event = asyncio.Event()
+        self.task = None
+
+    def start(self) -> None:
+        """Start reading the RX line in the background, if not already."""
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        """Read replies from the printer forever."""
+
+        response = bytearray(RESPONSE_MAX_LENGTH)
+        length = 0
+        while True:
+            data = await self.reader.read(1)
+            if not data:
+                continue
+            b = data[0]
+            if length or b == RESPONSE_HEADER:
+                if b == 0 and length >= 2:
+                    self.response_received(
+                        response[1], bytes(response[2:length])
+                    )
+                    length = 0
+                elif length == RESPONSE_MAX_LENGTH:
+                    # lost the NUL somewhere, start over
+                    length = 0
+                else:
+                    response[length] = b
+                    length += 1
+            elif b & STATUS_FIXED_MASK == STATUS_FIXED_BITS:
+                self.last_status = b
+                self.status_event.set()
+
+    def response_received(self, response_id: int, data: bytes) -> None:
+        """Handle a block reply from the printer.
+
+        Args:
+            response_id: The ID byte after the header
+            data: Everything between the ID and the NUL
+        """
+
+        if response_id != RESPONSE_PROCESS_ID:
+            self.responses[response_id] = data
+            self.response_event.set()
+            return
+        # everything up to this process ID has been printed
+        try:
+            pid = int(data.decode())
+        except ValueError:
+            return
+        self.printed_pid = pid
+        self.printed_event.set()
+
+    async def wait_response(
+            self, response_id: int, timeout: int = STATUS_TIMEOUT
+        ) -> bytes:
+        """Wait for a block reply. Clear any old one with responses.pop first.
+
+        Args:
+            response_id: The ID byte of the reply
+            timeout: Longest time to wait, in ms
+
+        Returns:
+            The data in the reply, or None if it didn't come in time
+        """
+
+        while response_id not in self.responses:
+            self.response_event.clear()
+            try:
+                await asyncio.wait_for_ms(self.response_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                break
+        return self.responses.pop(response_id, None)
+
+    async def query(self, n: int) -> int:
+        """Ask the printer for a real-time status byte.
+
+        Args:
+            n: Which status, one of the STATUS_ constants
+
+        Returns:
+            The status byte, or -1 if the printer didn't answer, in which
+            case it's marked as not available
+        """
+
+        async with self.status_lock:
+            self.status_event.clear()
+            #                      DLE EOT n
+            self.uart.write(bytes([16,  4, n]))
+            try:
+                await asyncio.wait_for_ms(
+                    self.status_event.wait(), STATUS_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                self.available = False
+                return -1
+            self.available = True
+            return self.last_status
+
+    def new_process_id(self) -> int:
+        """Get the next process ID to send, from 0 to 9999."""
+
+        pid = self.next_pid
+        self.next_pid = (self.next_pid + 1) % 10000
+        return pid
+
+    def printed(self, pid: int) -> bool:
+        """Check if the printer has finished up to a process ID.
+
+        IDs are handed out in order and wrap at 10000, so an ID counts as
+        printed if it's no more than half way around behind the last one.
+        """
+
+        if self.printed_pid < 0:
+            return False
+        return (self.printed_pid - pid) % 10000 < 5000
+
+    async def wait_printed(self, pid: int, timeout: int) -> bool:
+        """Wait for the printer to finish up to a process ID.
+
+        Args:
+            pid: The process ID
+            timeout: Longest time to wait, in ms
+
+        Returns:
+            True if it's been printed, False if the wait timed out
+        """
+
+        while not self.printed(pid):
+            self.printed_event.clear()
+            try:
+                await asyncio.wait_for_ms(self.printed_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return self.printed(pid)
+        return True
+
+    @staticmethod
+    def error_message(offline_cause: int, paper: int) -> str:
+        """Get a short message for what's stopping the printer, if anything.
+
+        Args:
+            offline_cause: Byte from STATUS_OFFLINE_CAUSE
+            paper: Byte from STATUS_PAPER
+
+        Returns:
+            A message that fits on the LCD, or '' if the printer is fine
+        """
+
+        if offline_cause & OFFLINE_COVER_OPEN:
+            return 'Cover open'
+        if offline_cause & OFFLINE_PAPER_END or paper & PAPER_END:
+            return 'Out of paper'
+        if offline_cause & OFFLINE_ERROR:
+            return 'Printer error'
+        return ''
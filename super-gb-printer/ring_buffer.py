@@ -0,0 +1,108 @@
+"""ByteRingBuffer class
+
+A preallocated, single producer/single consumer ring buffer for bytes coming
+in over the GB link. The IRQ handler is the only writer of head and the main
+loop is the only writer of tail, so no locking is needed between them.
+"""
+
+from micropython import const
+
+# head and tail run freely and are wrapped with this mask so they stay small
+# ints (no allocation in the IRQ) but can still be used as byte counters
+COUNTER_MASK = const(0x3FFFFFFF)
+
+
+class ByteRingBuffer():
+    """Ring buffer of received bytes with a matching table of reply bytes.
+
+    Each slot in rx holds one byte received from the Game Boy. The slot with
+    the same index in tx holds the byte that will be queued to the PIO right
+    after that byte is received, which means it goes out while the following
+    byte is being clocked in. The main loop fills in tx ahead of time so the
+    IRQ handler never has to work out what to send.
+    """
+
+    def __init__(self, size: int = 1024) -> None:
+        """Instantiate the class.
+
+        Args:
+            size: Number of slots, must be a power of two
+        """
+
+        if size & (size - 1):
+            raise ValueError('Ring buffer size must be a power of two!')
+        self.size = size
+        self.mask = size - 1
+        self.rx = bytearray(size)
+        self.tx = bytearray(size)
+        self.head = 0
+        self.tail = 0
+        self.overflows = 0
+
+    def clear(self) -> None:
+        """Throw away all pending bytes and queued reply bytes."""
+
+        self.head = 0
+        self.tail = 0
+        for i in range(self.size):
+            self.tx[i] = 0
+
+    def put(self, rx_byte: int) -> int:
+        """Store a received byte and return its queued reply byte.
+
+        Safe to call from a hard IRQ, nothing here allocates.
+
+        Args:
+            rx_byte: The byte received from the Game Boy
+
+        Returns:
+            The reply byte to hand to the PIO TX FIFO
+        """
+
+        idx = self.head & self.mask
+        self.rx[idx] = rx_byte
+        self.head = (self.head + 1) & COUNTER_MASK
+        return self.tx[idx]
+
+    def get(self) -> int:
+        """Pop the oldest received byte. Check available() first.
+
+        The reply for this slot has already gone out by now, so the slot is
+        reset to 0 for the next time around.
+        """
+
+        idx = self.tail & self.mask
+        self.tx[idx] = 0
+        self.tail = (self.tail + 1) & COUNTER_MASK
+        return self.rx[idx]
+
+    def available(self) -> int:
+        """Number of received bytes waiting to be parsed.
+
+        If the IRQ has lapped the main loop, the unread bytes are gone, so
+        they're dropped and counted as an overflow.
+        """
+
+        count = (self.head - self.tail) & COUNTER_MASK
+        if count > self.size:
+            self.overflows += 1
+            self.tail = self.head
+            return 0
+        return count
+
+    def set_reply(self, position: int, tx_byte: int) -> bool:
+        """Queue a reply byte to be sent after the byte at position arrives.
+
+        Args:
+            position: Byte counter value of the incoming byte
+            tx_byte: Byte to send back
+
+        Returns:
+            False if that byte has already been received, so it is too late
+            for the reply to be sent
+        """
+
+        if ((position - self.head) & COUNTER_MASK) >= self.size:
+            return False
+        self.tx[position & self.mask] = tx_byte
+        return True
@@ -4,12 +4,19 @@ Main script for the Super GB Printer. Will eventually get called main.py
 when this whole thing is done.
 """
 
-from machine import I2C, Pin
+import _thread
+import machine
+import typing
 import utime
+from machine import I2C, Pin
+from micropython import const
+import uasyncio as asyncio
 
 import data_buffer
 import fake_lcd
 import gb_link
+import job_archive
+import job_queue
 import pinout as pinn
 import pos_link
 import pin_manager
@@ -17,6 +24,11 @@ import utimeit
 
 from lcd_i2c import LCD
 
+# how often the reprint button is checked, and how long after the last press
+# the picked print starts
+BUTTON_POLL_MS = const(50)
+REPRINT_WAIT_MS = const(2000)
+
 class SuperPrinter():
     """Top level class for the printer.
     
@@ -39,17 +51,31 @@ class SuperPrinter():
         self.lcd.clear()
         self.print_logo()
 
-        self.data_buffer = data_buffer.DataBuffer(self.lcd)
+        # data_buffer is filled by the GB link on core 1, print_buffer holds
+        # the job being printed on core 0. POS buffers are only needed below
+        # 3x zoom, so they come from a pool shared between the two
+        pos_pool = data_buffer.PosBufferPool()
+        self.data_buffer = data_buffer.DataBuffer(self.lcd, pos_pool=pos_pool)
+        self.print_buffer = data_buffer.DataBuffer(
+            self.lcd, receive=False, pos_pool=pos_pool
+        )
         self.gb_link = gb_link.GBLink(self)
-        self.pos_link = pos_link.POSLink(self.data_buffer, self.lcd)
+        self.pos_link = pos_link.POSLink(self.print_buffer, self.lcd)
+
+        self.printing = False
+        # finished prints handed from core 1 to core 0
+        self.job_queue = job_queue.JobQueue(on_drop=self.drop_job)
+        # the last few prints, kept on flash for the reprint button
+        self.job_archive = job_archive.JobArchive(
+            on_release=self.archive_released
+        )
+        self.link_error = None
     
     def run(self) -> None:
         """The method to run after instantiatng a SuperPrinter."""
 
         try:
-            self.gb_link.startup()
-            self.pos_link.init_printer()
-            self.main_loop()
+            asyncio.run(self.main_loop())
         except (Exception, KeyboardInterrupt) as e:
             self.gb_link.shutdown_pio_mach()
             self.lcd.clear()
@@ -60,61 +86,373 @@ class SuperPrinter():
             self.lcd.print(e.__class__.__name__)
             raise e
     
-    def main_loop(self) -> None:
+    async def main_loop(self) -> None:
         """The main loop.
 
-        Runs continuously, checking if certain things are ready.
+        Starts the GB link on the second core, then runs a task for each
+        part of the job on this one. Each task sleeps until it has something
+        to do, so the board isn't busy waiting on anything.
         """
 
-        while True:
-            self.last_packet_time = utime.ticks_ms()
+        _thread.start_new_thread(self.link_thread, ())
+        await self.pos_link.init_printer()
+        await self.pos_link.negotiate_baudrate()
+        await self.pos_link.probe_download_capacity()
+        await asyncio.gather(
+            self.print_task(),
+            self.lcd_task(),
+            self.button_task(),
+            self.job_archive.run(self.flash_busy),
+        )
+
+    def link_thread(self) -> None:
+        """Runs the GB link and receiving side on the second core.
+
+        The link IRQs are set up from here so they're handled on this core
+        too. Finished prints are frozen into a PrintJob, along with the
+        print settings, and queued for the print task as soon as there's
+        room, which lets the Game Boy carry on with the next print while
+        earlier ones are still on paper.
+
+        This is a plain loop rather than uasyncio tasks woken by a
+        ThreadSafeFlag, since uasyncio keeps one scheduler for the whole
+        board and it's already running the print side on core 0. Instead,
+        machine.idle() sleeps the core until the next interrupt, which is
+        the link IRQ (or the 1 ms tick), so it still only wakes up when
+        there's something to do.
+        """
+
+        try:
+            self.gb_link.startup()
             while True:
                 # byte handling done via PIO and IRQ method in gb_link
                 self.gb_link.check_handle_packet()
-                if self.gb_link.check_print_ready():
-                    self.print()
+                # get a head start on the print while the Game Boy is busy,
+                # which happens on the fly while sending instead when pages
+                # skip the POS buffer. If RAM is running out, making room on
+                # flash comes first, but only while the Game Boy waits on a
+                # PRINT command, since flash writes stall the link.
+                self.data_buffer.preconvert = self.uses_pos_buffer(
+                    self.btn.zoom
+                )
+                working = self.gb_link.between_packets and (
+                    (
+                        self.gb_link.emulating_print
+                        and self.data_buffer.spill_in_background()
+                    )
+                    or self.data_buffer.convert_in_background()
+                )
+                if (
+                    self.gb_link.end_of_print_data
+                    and self.job_queue.put_if_room(
+                        self.data_buffer.job_size, self.take_job
+                    )
+                ):
+                    print(f'Queued a job, {len(self.job_queue)} waiting')
                 self.gb_link.check_timeout()
+                if not working:
+                    # wakes up on the next link IRQ
+                    machine.idle()
+        except Exception as e:
+            self.link_error = e
+            self.gb_link.shutdown_pio_mach()
 
-    def print(self) -> None:
-        """Runs a print job.
+    def take_job(self) -> typing.Optional[data_buffer.PrintJob]:
+        """Freezes the received print into a PrintJob, once it's finished.
 
-        Shuts down the GB link PIO while running so any Game Boy software
-        will immediately throw an error while the print is processing.
-        
-        Does the following tasks:
-        - Converts the incoming GB tile data to the POS printer format
-        - Sends data to the printer, enlarging it as needed
-        - Send print and cut paper commands to the printer
+        Called by JobQueue.put_if_room once there's room for the job.
+        """
+
+        if not self.gb_link.take_finished_print():
+            return None
+        job = self.data_buffer.freeze_job()
+        job.margins = self.gb_link.print_margins
+        job.palette = self.gb_link.print_palette
+        job.exposure = self.gb_link.print_exposure
+        job.zoom = self.btn.zoom
+        job.add_bottom_margin = self.btn.add_bottom_margin
+        job.copies = self.btn.copies
+        return job
+
+    def drop_job(self, job: data_buffer.PrintJob) -> None:
+        """Cleans up after a job the queue threw away to make room.
+
+        Can run on either core, so only the buffers and job file are seen
+        to here. The archive is only touched from the print task, which
+        picks up dropped reprints with JobQueue.take_dropped.
+        """
+
+        self.data_buffer.discard_job(job)
+
+    def archive_released(self, job: data_buffer.PrintJob) -> None:
+        """Stops counting a printed job's arena once the archive is done."""
+
+        self.job_queue.release(len(job.arena))
+
+    async def print_task(self) -> None:
+        """Prints each job handed over by the link thread, oldest first."""
+
+        while True:
+            job = await self.job_queue.get()
+            # a job file is handed to the archive rather than deleted
+            job.keep_job_file = True
+            self.print_buffer.load_job(job)
+            await self.print(job)
+            self.print_buffer.finish_job()
+            if job.archive_seq < 0:
+                # its arena counts against the queue's cap until it's saved
+                self.job_queue.done(job, held_bytes=len(job.arena))
+                self.job_archive.add(job)
+            else:
+                self.job_queue.done(job)
+                self.job_archive.done(job)
+            for dropped in self.job_queue.take_dropped():
+                if dropped.archive_seq >= 0:
+                    self.job_archive.done(dropped)
+
+    def uses_pos_buffer(self, zoom: int, num_packets: int = 0) -> bool:
+        """Check if a print goes through the POS buffer.
+
+        Only below 3x, and only if its pages fit in the POS buffer. Either
+        the whole print fits, like a single Game Boy Camera photo, and its
+        first page was converted as it came in, or the pages that fit in
+        the printer (see POSLink.page_packets) are no bigger than that.
+        Longer prints go in taller pages, converted as they're sent.
 
-        If there is more than 18 packets of data, it is processed, sent, and
-        printed in "pages" of 18 packets, then cut at the end.
+        Args:
+            zoom: Zoom level of the print
+            num_packets: Packets in the print, or 0 while it's still coming
+                in, when it's taken to fit
         """
 
-        self.gb_link.shutdown_pio_mach()
+        if zoom >= 3:
+            return False
+        if num_packets <= data_buffer.PACKETS_PER_PAGE:
+            return True
+        page_packets = self.pos_link.page_packets(zoom)
+        return page_packets <= data_buffer.PACKETS_PER_PAGE
+
+    def flash_busy(self) -> bool:
+        """Check if anything is going on that archive writes would slow.
+
+        Flash writes stop both cores for a moment, which is no good while
+        printing or while the Game Boy is sending.
+        """
+
+        return bool(
+            self.printing
+            or len(self.job_queue)
+            or self.data_buffer.num_packets
+        )
+
+    async def button_task(self) -> None:
+        """Reprints archived prints from the button.
+
+        The first press picks the newest print and each press after that
+        goes one further back, wrapping round. The picked print is queued
+        once the button's been left alone for a bit.
+        """
+
+        picked = -1
+        last_press = 0
+        was_pressed = False
+        while True:
+            await asyncio.sleep_ms(BUTTON_POLL_MS)
+            pressed = self.btn.reprint_button
+            now = utime.ticks_ms()
+            num_saved = len(self.job_archive)
+            if pressed and not was_pressed and num_saved:
+                picked = (picked + 1) % num_saved
+                last_press = now
+                if not self.printing:
+                    self.lcd.clear()
+                    self.lcd.print(f"Reprint {picked+1}/{num_saved}")
+            was_pressed = pressed
+            if (
+                picked >= 0
+                and utime.ticks_diff(now, last_press) > REPRINT_WAIT_MS
+            ):
+                try:
+                    job = self.job_archive.load(min(picked, num_saved - 1))
+                except (OSError, ValueError) as e:
+                    print(f'Could not load print: {e}')
+                    picked = -1
+                    continue
+                picked = -1
+                job.copies = self.btn.copies
+                job.num_bytes += data_buffer.print_overhead(
+                    True,
+                    self.uses_pos_buffer(job.zoom, job.num_packets),
+                    job.num_packets,
+                )
+                if self.job_queue.put_if_room(job.num_bytes, lambda: job):
+                    print('Queued a reprint')
+                else:
+                    self.job_archive.done(job)
+
+    async def lcd_task(self) -> None:
+        """Shows messages from the GB link and how many packets are in.
+
+        Also passes on any error from the link thread so it gets reported
+        like one from this core.
+        """
+
+        shown_message = ''
+        shown_packets = 0
+        while True:
+            await asyncio.sleep_ms(250)
+            if self.link_error:
+                raise self.link_error
+            if self.printing:
+                continue
+            message = self.gb_link.lcd_message
+            num_packets = self.data_buffer.num_packets
+            if message != shown_message:
+                self.lcd.clear()
+                self.lcd.print(message)
+                shown_message = message
+            if num_packets != shown_packets and num_packets:
+                self.lcd.set_cursor(0, 1)
+                self.lcd.print(f"Received {num_packets:02}")
+            shown_packets = num_packets
+
+    async def print(self, job: data_buffer.PrintJob) -> None:
+        """Runs the print job loaded in the print buffer.
+
+        The GB link keeps running on the other core while this goes, and
+        more prints can queue up in the meantime.
+        
+        Prints the pages (see print_pages) and cuts the paper after each
+        copy. If everything uploaded for the first copy is still in the
+        printer afterwards, the other copies are printed from there
+        without uploading anything again.
+        """
+
+        self.printing = True
         print('Commencing print')
-        self.pos_link.set_justification(1)
-        if self.btn.no_scale:
-            zoom = 1
-        elif self.btn.scale_2x:
-            zoom = 2
-        else:
-            zoom = 3
-        for p in range(self.data_buffer.num_pages):
-            print(f'Sending page {p+1} of {self.data_buffer.num_pages}')
-            num_pkts = self.data_buffer.convert_page_of_packets(p)
-            self.pos_link.send_data_buffer_to_download(zoom)
-            self.lcd.set_cursor(0, 0)
-            self.lcd.print("Printing page...")
-            self.pos_link.print_download_graphics_data(zoom)
-            utime.sleep(.15 * num_pkts)
+        start_bytes = self.pos_link.bytes_sent
+        start_time = utime.ticks_ms()
+        skipped_rows = 0
+        await self.pos_link.set_justification(1)
+        # pages are sized and reused going by what's stored in the printer
+        await self.pos_link.check_download_area()
+        recording = None
+        for copy in range(job.copies):
+            if job.copies > 1:
+                print(f'Printing copy {copy+1} of {job.copies}')
+            if recording is not None and self.pos_link.resident(recording):
+                await self.pos_link.replay(recording)
+            else:
+                if recording is not None:
+                    # the first page was converted over by now
+                    self.print_buffer.num_preconverted_packets = 0
+                self.pos_link.start_recording()
+                skipped_rows += await self.print_pages(job)
+                recording = self.pos_link.stop_recording()
+            if job.add_bottom_margin:
+                await self.pos_link.cut(feed_height=184)
+            else:
+                await self.pos_link.cut()
+        # returns straight away if the printer doesn't report its status
+        await self.pos_link.wait_printed()
+        sent = self.pos_link.bytes_sent - start_bytes
+        elapsed = utime.ticks_diff(utime.ticks_ms(), start_time)
+        saved = self.pos_link.download_size(skipped_rows, job.zoom)
+        print(f'Sent {sent} bytes in {elapsed} ms')
+        print(f'Fed past {skipped_rows} blank rows, saving {saved} bytes')
+        print(
+            f'Page cache hits {self.pos_link.cache_hits}, '
+            f'misses {self.pos_link.cache_misses}'
+        )
+        print(
+            f'Peak memory {job.peak_bytes} bytes receiving, '
+            f'{self.print_buffer.peak_bytes} printing, '
+            f'{job.num_packets * data_buffer.PACKET_SIZE} uncompressed'
+        )
         self.lcd.clear()
         self.lcd.print("Print complete!")
-        utime.sleep(.5)
-        if self.btn.add_bottom_margin:
-            self.pos_link.cut(feed_height=184)
-        else:
-            self.pos_link.cut()
-        self.gb_link.startup_pio_mach(keep_message=True)
+        self.lcd.set_cursor(0, 1)
+        self.lcd.print(f"{sent // 1024}KB {elapsed / 1000:.1f}s")
+        self.printing = False
+
+    async def print_pages(self, job: data_buffer.PrintJob) -> int:
+        """Prints one copy of the job loaded in the print buffer.
+
+        Does the following tasks:
+        - Converts the incoming GB tile data to the POS printer format
+        - Sends data to the printer, enlarging it as needed (at 3x, the
+          conversion is done packet by packet while sending)
+        - Send print commands to the printer
+
+        The data is processed, sent, and printed in "pages" of as many
+        packets as fit in the printer at the zoom (see POSLink.page_packets),
+        9 at 3x and a lot more below that. Prints that go through the POS
+        buffer (see uses_pos_buffer) use pages no bigger than it, with each
+        page after the first converted into a second POS buffer while the
+        one before it is sent and printed.
+
+        Runs of blank rows in a page aren't sent, the paper is just fed past
+        them, so only the bands in between are uploaded and printed. The
+        margins of each GB PRINT command in the job are fed the same way.
+
+        Returns:
+            The number of blank rows fed past
+        """
+
+        skipped_rows = 0
+        zoom = job.zoom
+        to_pos = self.uses_pos_buffer(zoom, job.num_packets)
+        page_packets = self.pos_link.page_packets(zoom)
+        if to_pos:
+            page_packets = min(page_packets, data_buffer.PACKETS_PER_PAGE)
+        self.print_buffer.packets_per_page = page_packets
+        num_pages = self.print_buffer.num_pages
+        convert_ahead = None
+        margin_before, margin_after = job.margin_rows()
+        await self.pos_link.feed(margin_before.pop(0, 0) * zoom)
+        for p in range(num_pages):
+            print(f'Sending page {p+1} of {num_pages}')
+            if convert_ahead:
+                await convert_ahead
+            self.print_buffer.convert_page_of_packets(p, to_pos=to_pos)
+            if to_pos and p + 1 < num_pages:
+                # convert the next page while this one uploads and prints
+                convert_ahead = asyncio.create_task(
+                    self.print_buffer.convert_page_in_back(p + 1)
+                )
+            # bands also need to start and end where the margins go
+            page_row = (
+                self.print_buffer.page_start * data_buffer.ROWS_PER_PACKET
+            )
+            splits = set(
+                row - page_row
+                for row in set(margin_before) | set(margin_after)
+            )
+            for start, end, blank in self.print_buffer.page_bands(splits):
+                await self.pos_link.feed(
+                    margin_before.pop(page_row + start, 0) * zoom
+                )
+                if blank:
+                    await self.pos_link.feed((end - start) * zoom)
+                    skipped_rows += end - start
+                else:
+                    await self.pos_link.send_data_buffer_to_download(
+                        zoom, start, end
+                    )
+                    self.lcd.set_cursor(0, 0)
+                    self.lcd.print("Printing page...")
+                    # the next band goes under another keycode if there's
+                    # room, so it can upload while this one prints
+                    await self.pos_link.print_download_graphics_data(
+                        zoom, keycode=self.pos_link.keycode
+                    )
+                await self.pos_link.feed(
+                    margin_after.pop(page_row + end, 0) * zoom
+                )
+        # margins at the very end, or of PRINT commands with no data
+        for rows in list(margin_before.values()) + list(margin_after.values()):
+            await self.pos_link.feed(rows * zoom)
+        return skipped_rows
     
     gb_chars = [
         [0x1F, 0x10, 0x17, 0x17, 0x17, 0x17, 0x17, 0x00],
@@ -18,4 +18,13 @@ def timeit_us(f, *args, **kwargs):
         micros = utime.ticks_diff(utime.ticks_us(), t)
         print(f'{f.__name__} execution time: {micros} us')
         return result
-    return new_func
\ No newline at end of file
+    return new_func
+
+def timeit_async(f, *args, **kwargs):
+    async def new_func(*args, **kwargs):
+        t = utime.ticks_ms()
+        result = await f(*args, **kwargs)
+        micros = utime.ticks_diff(utime.ticks_ms(), t)
+        print(f'{f.__name__} execution time: {micros} ms')
+        return result
+    return new_func